@@ -2,17 +2,37 @@
 set -e
 set -u
 
-# checksums
-sashimi_md5="b8ee3a415a80030ce92de15f40054a40"
-sashimi_anno_md5="131d3ad1bb27c91693c342fbc0667d48"
-sashimi_color_md5="41fee9e7e51a13a09c6d068cc6cb93cf"
-sashimi_aggr_md5="50674d8812194bbb8f8f8ddab9238b3d"
+# checksums of the R script and data written for each mode, which do not
+# depend on the versions of R and ggplot2
+sashimi_md5="677650beb9d5f80e4d25709debb7eebf"
+sashimi_anno_md5="f9b37dabc588fa27381af41f5efea947"
+sashimi_color_md5="cef4fabef0b1f69b475d2ac3fa9776b7"
+sashimi_aggr_md5="a6dd54860920601f4905d122c8d58e71"
+
+# checksums of the plots drawn for each mode by the R and ggplot2 of
+# .travis.yml. Run `bash ci/run.sh --update` there to record them
+sashimi_pdf_md5=""
+sashimi_anno_pdf_md5=""
+sashimi_color_pdf_md5=""
+sashimi_aggr_pdf_md5=""
 
 fail() {
     echo ${1-""} >&2 && exit 1
 }
 
-# export GGSASHIMI_DEBUG=1
+check() {
+    # check <variable> <md5>, or record the md5 with --update
+    if [[ $update == 1 ]]; then
+        sed -i "s/^$1=.*/$1=\"$2\"/" "$0"
+        echo "== Recorded $1=$2"
+    elif [[ -z $(eval 'echo $'$1) ]]; then
+        fail "== No checksum recorded for $1 ($2). Run 'bash ci/run.sh --update' in the CI environment"
+    else
+        [[ $2 == $(eval 'echo $'$1) ]] || fail "== Wrong checksum for $1: $2"
+    fi
+}
+
+[[ ${1-""} == "--update" ]] && update=1 || update=0
 
 modes=( sashimi sashimi_anno sashimi_color sashimi_aggr )
 
@@ -20,13 +40,14 @@ for m in ${modes[@]}; do
     [[ $m == "sashimi_anno" ]] && anno="-g examples/annotation.gtf" || anno=""
     [[ $m == "sashimi_color" ]] && color="-C 3" || color=""
     [[ $m == "sashimi_aggr" ]] && aggr="-C 3 -O 3 -A mean_j" || aggr=""
+    GGSASHIMI_DEBUG=1 ./sashimi-plot.py $anno -b examples/input_bams.tsv -c chr10:27040584-27048100 $color $aggr
+    check ${m}_md5 $(sed "s|$(pwd -P)/R_data|R_data|" R_script | cat - R_data | md5sum | awk '$0=$1')
+    rm -f R_script R_data sashimi.pdf
     ./sashimi-plot.py $anno -b examples/input_bams.tsv -c chr10:27040584-27048100 $color $aggr
-    md5=$(sed '/^\/\(.\+Date\|Producer\)/d' sashimi.pdf | md5sum | awk '$0=$1')
-    [[ $md5 == $(eval 'echo $'$m'_md5') ]] || fail "== Wrong checksum for $m mode: $md5"
+    check ${m}_pdf_md5 $(sed '/^\/\(.\+Date\|Producer\)/d' sashimi.pdf | md5sum | awk '$0=$1')
 done
 
 echo "== All checksums match"
 echo "== DONE"
 
 exit 0
-
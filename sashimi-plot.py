@@ -1,10 +1,36 @@
 #!/usr/bin/env python
 
 # Import modules
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 import subprocess as sp
-import sys, re, copy, os, codecs
-from collections import OrderedDict
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+import sys, re, os, codecs, tempfile, gzip, json, mmap, hashlib, time, math, threading, zlib, shutil
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from numbers import Integral
+
+try:
+        from itertools import accumulate
+except ImportError:
+        # python 2
+        def accumulate(iterable):
+                total = 0
+                for v in iterable:
+                        total += v
+                        yield total
+
+try:
+        from queue import Queue
+except ImportError:
+        # python 2
+        from Queue import Queue
+
+try:
+        import pysam
+except ImportError:
+        pysam = None
 
 def define_options():
         # Argument parsing
@@ -17,8 +43,25 @@ def define_options():
                 2col: path of bam file,
                 3+col: additional columns
                 """)
-        parser.add_argument("-c", "--coordinates", type=str, required=True,
-                help="Genomic region. Format: chr:start-end. Remember that bam coordinates are 0-based")
+        region = parser.add_mutually_exclusive_group(required=True)
+        region.add_argument("-c", "--coordinates", type=str,
+                help="""Genomic region. Format: chr:start-end. Remember that bam coordinates are 0-based.
+                A gene name, gene id, transcript name or transcript id from the gtf file (-g) is also accepted""")
+        region.add_argument("--regions", type=str,
+                help="""BED file with the regions to plot in batch. The bam files, the palette and the gtf file are read
+                once for all of them. Plots are named <out-prefix>_<name>, with the name taken from the 4th column of
+                the BED file or made from the coordinates, and a summary of the outputs and timings is written to
+                <out-prefix>_summary.tsv""")
+        parser.add_argument("--region-jobs", type=int, default=1, dest="region_jobs",
+                help="Number of regions of a --regions batch plotted in parallel [default=%(default)s]")
+        parser.add_argument("--queue-size", type=int, default=2, dest="queue_size",
+                help="Number of regions of a --regions batch read ahead while R draws the current one [default=%(default)s]")
+        parser.add_argument("--single-pass", action="store_true", dest="single_pass",
+                help="""Read each bam file once for all the regions of a --regions batch, merging overlapping regions.
+                All the bam files are read before the first plot, so reading no longer overlaps drawing (--queue-size), and the
+                time spent reading is reported once, in the single_pass row of the summary [default=%(default)s]""")
+        parser.add_argument("--pad", type=int, default=0,
+                help="Number of bases added on each side of the gene or transcript given with -c [default=%(default)s]")
         parser.add_argument("-o", "--out-prefix", type=str, dest="out_prefix", default="sashimi",
                 help="Prefix for plot file name [default=%(default)s]")
         parser.add_argument("-S", "--out-strand", type=str, dest="out_strand", default="both",
@@ -29,6 +72,16 @@ def define_options():
                 help="Junction BED file name [default=no junction file]")
         parser.add_argument("-g", "--gtf",
                 help="Gtf file with annotation (only exons is enough)")
+        parser.add_argument("--index-gtf", action="store_true", dest="index_gtf",
+                help="Make a bgzipped, tabix-indexed copy of the gtf on first use and only read the records in the region. Bgzipped gtf files with a tabix index are always queried by region [default=%(default)s]")
+        parser.add_argument("--gtf-cache", action="store_true", dest="gtf_cache",
+                help="Store the parsed gtf in a binary cache, rebuilt when the gtf changes, and read the annotation from it [default=%(default)s]")
+        parser.add_argument("--cache-dir", type=str, dest="cache_dir",
+                help="Directory for cache files [default=next to the input files]")
+        parser.add_argument("--read-cache", action="store_true", dest="read_cache",
+                help="Store the coverage and junctions read from each bam file in a region under --cache-dir and read them from there while the bam file is unchanged [default=%(default)s]")
+        parser.add_argument("--read-cache-size", type=int, default=1024, dest="read_cache_size",
+                help="Size limit of the --read-cache in MB. The least recently used entries are removed beyond it [default=%(default)s]")
         parser.add_argument("-s", "--strand", default="NONE", type=str,
                 help="Strand specificity: <NONE> <SENSE> <ANTISENSE> <MATE1_SENSE> <MATE2_SENSE> [default=%(default)s]")
         parser.add_argument("--shrink", action="store_true",
@@ -57,13 +110,51 @@ def define_options():
         parser.add_argument("--base-size", type=float, default=14, dest="base_size",
                 help="Base font size of the plot in pch [default=%(default)s]")
         parser.add_argument("-F", "--out-format", type=str, default="pdf", dest="out_format",
-                help="Output file format: <pdf> <svg> <png> <jpeg> <tiff> [default=%(default)s]")
+                help="Output file format: <pdf> <svg> <png> <jpeg> <tiff>. Use a comma-separated list (e.g. pdf,png) to write several formats at once [default=%(default)s]")
         parser.add_argument("-R", "--out-resolution", type=int, default=300, dest="out_resolution",
                 help="Output file resolution in PPI (pixels per inch). Applies only to raster output formats [default=%(default)s]")
+        parser.add_argument("--bin-threshold", type=int, default=100000, dest="bin_threshold",
+                help="Bin the coverage to about width x out-resolution bins for regions longer than this number of bases. Set to 0 to disable binning [default=%(default)s]")
+        parser.add_argument("--bin-reducer", type=str, default="max", dest="bin_reducer",
+                help="Function to summarize the coverage of each bin: <max> <min> <mean> [default=%(default)s]")
+        parser.add_argument("--reader", type=str, default="samtools",
+                help="Backend used to read alignments: <samtools> <pysam>. pysam reads the bam index in-process [default=%(default)s]")
+        parser.add_argument("--jobs", type=int, default=1,
+                help="Number of bam files read in parallel [default=%(default)s]")
+        parser.add_argument("--tile-size", type=int, default=0, dest="tile_size",
+                help="""Read regions longer than this number of bases in tiles of this size, keeping the coverage of the
+                tiles already read as runs instead of a per-base array of the whole region. 0 disables tiling [default=%(default)s]""")
+        parser.add_argument("--r-worker", action="store_true", dest="r_worker",
+                help="Render all plots in a single long-lived R process that loads the R libraries once [default=%(default)s]")
 #       parser.add_argument("-s", "--smooth", action="store_true", default=False, help="Smooth the signal histogram")
         return parser
 
 
+def define_index_options():
+        # Argument parsing of the index command
+        parser = ArgumentParser(prog="sashimi-plot.py index",
+                description="""Build a coverage store for each bam file, with its compressed coverage and junctions per
+                chromosome and strand, that can be given instead of the bam file to plot any region without reading it""")
+        parser.add_argument("-b", "--bam", type=str, required=True,
+                help="Individual bam file or file with a list of bam files, as for plotting")
+        parser.add_argument("-o", "--out-dir", type=str, dest="out_dir", default=".",
+                help="""Directory for the stores, named <id>.store, and for stores.tsv, a copy of the list of bam
+                files pointing at the stores [default=%(default)s]""")
+        parser.add_argument("-s", "--strand", default="NONE", type=str,
+                help="Strand specificity: <NONE> <SENSE> <ANTISENSE> <MATE1_SENSE> <MATE2_SENSE>. Stores are plotted with the same --strand [default=%(default)s]")
+        parser.add_argument("--chunk-size", type=int, default=65536, dest="chunk_size",
+                help="Number of bases of each compressed chunk of coverage, a multiple of %d [default=%%(default)s]" % STORE_LEVELS[-1])
+        parser.add_argument("--reader", type=str, default="samtools",
+                help="Backend used to read alignments: <samtools> <pysam> [default=%(default)s]")
+        parser.add_argument("--jobs", type=int, default=1,
+                help="Number of bam files indexed in parallel [default=%(default)s]")
+        return parser
+
+
+
+def is_region(c):
+        return re.match("^[^:]+:[0-9,]+-[0-9,]+$", c) is not None
+
 
 def parse_coordinates(c):
         c = c.replace(",", "")
@@ -75,15 +166,20 @@ def parse_coordinates(c):
 
 
 
-def count_operator(CIGAR_op, CIGAR_len, pos, start, end, a, junctions):
+def count_operator(CIGAR_op, CIGAR_len, pos, start, end, a, junctions, diff=False):
 
         # Match
         if CIGAR_op == "M":
-                for i in range(pos, pos + CIGAR_len):
-                        if i < start or i >= end:
-                                continue
-                        ind = i - start
-                        a[ind] += 1
+                # Clip the block to the [start, end) window
+                block_start, block_end = max(pos, start) - start, min(pos + CIGAR_len, end) - start
+                if block_start < block_end:
+                        if diff:
+                                # Only record the block boundaries in the difference array
+                                a[block_start] += 1
+                                a[block_end] -= 1
+                        else:
+                                for ind in range(block_start, block_end):
+                                        a[ind] += 1
 
         # Insertion or Soft-clip
         if CIGAR_op == "I" or CIGAR_op == "S":
@@ -105,6 +201,101 @@ def count_operator(CIGAR_op, CIGAR_len, pos, start, end, a, junctions):
         return pos
 
 
+def coverage_runs(d, start):
+        # Run-length encoded coverage from a difference array: genomic start,
+        # coverage and length of each stretch of constant coverage
+        n = len(d) - 1
+        bounds = [0] + [i for i in range(1, n) if d[i]] + [n]
+        x = [start + i for i in bounds[:-1]]
+        y = list(accumulate(d[i] for i in bounds[:-1]))
+        w = [j - i for i, j in zip(bounds[:-1], bounds[1:])]
+        return x, y, w
+
+
+def run_value(a, pos):
+        x, y, _ = a
+        return y[bisect_right(x, pos) - 1]
+
+
+def split_runs(x, y, w, keep):
+        # Split the runs so that each position in keep is a run of its own
+        keep = sorted(keep)
+        new_x, new_y, new_w = [], [], []
+        for run_start, v, l in zip(x, y, w):
+                run_end = run_start + l
+                for pos in keep[bisect_left(keep, run_start):bisect_left(keep, run_end)]:
+                        if pos > run_start:
+                                new_x.append(run_start)
+                                new_y.append(v)
+                                new_w.append(pos - run_start)
+                        new_x.append(pos)
+                        new_y.append(v)
+                        new_w.append(1)
+                        run_start = pos + 1
+                if run_start < run_end:
+                        new_x.append(run_start)
+                        new_y.append(v)
+                        new_w.append(run_end - run_start)
+        return new_x, new_y, new_w
+
+
+def clip_runs(a, start, end):
+        # Runs of the positions in [start, end)
+        x, y, w = a
+        new_x, new_y, new_w = [], [], []
+        for i in range(max(0, bisect_right(x, start) - 1), bisect_left(x, end)):
+                run_start, run_end = max(x[i], start), min(x[i] + w[i], end)
+                if run_start < run_end:
+                        new_x.append(run_start)
+                        new_y.append(y[i])
+                        new_w.append(run_end - run_start)
+        return new_x, new_y, new_w
+
+
+def join_runs(pieces):
+        # Concatenate the runs of consecutive stretches, merging runs of the
+        # same value across them
+        new_x, new_y, new_w = [], [], []
+        for x, y, w in pieces:
+                for run_start, v, l in zip(x, y, w):
+                        if new_y and new_y[-1] == v:
+                                new_w[-1] += l
+                                continue
+                        new_x.append(run_start)
+                        new_y.append(v)
+                        new_w.append(l)
+        return new_x, new_y, new_w
+
+
+def aggregate_runs(tracks, f):
+        # Apply f across the coverage runs of several tracks of the same region
+        bounds = sorted(set(run_start for x, _, _ in tracks for run_start in x))
+        bounds.append(max(x[-1] + w[-1] for x, _, w in tracks))
+        ind = [0] * len(tracks)
+        new_x, new_y, new_w = [], [], []
+        for run_start, run_end in zip(bounds[:-1], bounds[1:]):
+                values = []
+                for t, (x, y, _) in enumerate(tracks):
+                        while ind[t] + 1 < len(x) and x[ind[t] + 1] <= run_start:
+                                ind[t] += 1
+                        values.append(y[ind[t]])
+                v = f(values)
+                if new_y and new_y[-1] == v:
+                        new_w[-1] += run_end - run_start
+                        continue
+                new_x.append(run_start)
+                new_y.append(v)
+                new_w.append(run_end - run_start)
+        return new_x, new_y, new_w
+
+
+def read_strand(s, samflag):
+        # Strand of the signal of a read
+        if s == "NONE":
+                return "+"
+        return ["+", "-"][flip_read(s, samflag) ^ bool(samflag & 16)]
+
+
 def flip_read(s, samflag):
         if s == "NONE" or s == "SENSE":
                 return 0
@@ -122,45 +313,799 @@ def flip_read(s, samflag):
                         return 0
 
 
-def read_bam(f, c, s):
+# CIGAR operators in the order of their BAM binary codes
+CIGAR_OPS = "MIDNSHP=X"
 
-        _, start, end = parse_coordinates(c)
+# Reads with any of these more exotic CIGAR operators are ignored
+SKIPPED_CIGAR_OPS = "HP=X"
+
+
+SAMTOOLS_MULTI_REGION = None
 
-        # Initialize coverage array and junction dict
-        a = {"+" : [0] * (end - start)}
-        junctions = {"+": OrderedDict()}
-        if s != "NONE":
-                a["-"] = [0] * (end - start)
-                junctions["-"] = OrderedDict()
 
-        p = sp.Popen("samtools view %s %s " %(f, c), shell=True, stdout=sp.PIPE)
-        for line in p.communicate()[0].decode('utf8').strip().split("\n"):
+def samtools_multi_region():
+        # Whether samtools view has the multi-region iterator (-M), which
+        # older versions lack. Checked once per process
+        global SAMTOOLS_MULTI_REGION
+        if SAMTOOLS_MULTI_REGION is None:
+                p = sp.Popen("samtools view", shell=True, stdout=sp.PIPE, stderr=sp.STDOUT)
+                usage = p.communicate()[0].decode('utf8')
+                SAMTOOLS_MULTI_REGION = re.search(r"^\s*-M\b", usage, re.M) is not None
+        return SAMTOOLS_MULTI_REGION
 
+
+def samtools_view(f, regions):
+        # Several regions are read in one pass by the multi-region iterator,
+        # which reports each alignment once
+        multi = "-M " if len(regions) > 1 else ""
+        p = sp.Popen("samtools view %s%s %s " %(multi, f, " ".join(regions)), shell=True, stdout=sp.PIPE)
+        # Parse records while samtools is still decompressing, one line at a time
+        for line in p.stdout:
+
+                line = line.decode('utf8').strip()
                 if line == "":
                         continue
 
-                line_sp = line.strip().split("\t")
-                samflag, read_start, CIGAR = line_sp[1], int(line_sp[3]), line_sp[5]
+                # Only the first six fields are needed
+                line_sp = line.split("\t", 6)
+                samflag, chr, read_start, CIGAR = int(line_sp[1]), line_sp[2], int(line_sp[3]), line_sp[5]
 
                 # Ignore reads with more exotic CIGAR operators
-                if any(map(lambda x: x in CIGAR, ["H", "P", "X", "="])):
+                if any(map(lambda x: x in CIGAR, SKIPPED_CIGAR_OPS)):
                         continue
 
-                read_strand = ["+", "-"][flip_read(s, samflag) ^ bool(int(samflag) & 16)]
-                if s == "NONE": read_strand = "+"
-
                 CIGAR_lens = re.split("[MIDNS]", CIGAR)[:-1]
                 CIGAR_ops = re.split("[0-9]+", CIGAR)[1:]
 
+                yield chr, samflag, read_start, zip(CIGAR_ops, map(int, CIGAR_lens))
+
+        p.stdout.close()
+        if p.wait() != 0:
+                raise IOError("samtools view exited with status %d on %s" %(p.returncode, f))
+
+
+def samtools_alignments(f, regions):
+        if len(regions) < 2 or samtools_multi_region():
+                for read in samtools_view(f, regions):
+                        yield read
+                return
+        # The sorted, disjoint regions are read one at a time, skipping the
+        # alignments overlapping the previous region as pysam_alignments does
+        last = None
+        for c in regions:
+                chr, start, end = parse_coordinates(c)
+                for read in samtools_view(f, [c]):
+                        if last is not None and last[0] == chr and read[2] - 1 < last[2]:
+                                continue
+                        yield read
+                last = chr, start, end
+
+
+def pysam_alignments(f, regions):
+        bam = pysam.AlignmentFile(f, "rb")
+        references = set(bam.references)
+        last = None
+        for c in regions:
+                chr, start, end = parse_coordinates(c)
+                # Chromosomes missing from the bam file have no reads, as with samtools
+                if chr not in references:
+                        continue
+                for read in bam.fetch(chr, start, end):
+
+                        # Alignments overlapping the previous (sorted, disjoint) region were already reported
+                        if last is not None and last[0] == chr and read.reference_start < last[2]:
+                                continue
+
+                        CIGAR = read.cigartuples
+                        if not CIGAR:
+                                continue
+
+                        # Ignore reads with more exotic CIGAR operators
+                        if any(CIGAR_OPS[op] in SKIPPED_CIGAR_OPS for op, _ in CIGAR):
+                                continue
+
+                        # Report 1-based positions as samtools view does
+                        yield chr, read.flag, read.reference_start + 1, ((CIGAR_OPS[op], l) for op, l in CIGAR)
+                last = chr, start, end
+
+        bam.close()
+
+
+BAM_READERS = {
+        "samtools": samtools_alignments,
+        "pysam": pysam_alignments,
+}
+
+
+class RegionCoverage(object):
+        # Coverage difference arrays and junction counts of one region, per strand
+
+        def __init__(self, c, s):
+                self.chr, self.start, self.end = parse_coordinates(c)
+                self.s = s
+                self.d = {"+": array("i", [0]) * (self.end - self.start + 1)}
+                self.junctions = {"+": OrderedDict()}
+                if s != "NONE":
+                        self.d["-"] = array("i", [0]) * (self.end - self.start + 1)
+                        self.junctions["-"] = OrderedDict()
+
+        def add(self, samflag, read_start, CIGAR):
+                strand = read_strand(self.s, samflag)
+
                 pos = read_start
 
-                for n, CIGAR_op in enumerate(CIGAR_ops):
-                        CIGAR_len = int(CIGAR_lens[n])
-                        pos = count_operator(CIGAR_op, CIGAR_len, pos, start, end, a[read_strand], junctions[read_strand])
+                for CIGAR_op, CIGAR_len in CIGAR:
+                        pos = count_operator(CIGAR_op, CIGAR_len, pos, self.start, self.end, self.d[strand], self.junctions[strand], diff=True)
+
+        def result(self):
+                a = dict((strand, coverage_runs(self.d[strand], self.start)) for strand in self.d)
+                return a, self.junctions
+
+
+class TileEvents(object):
+        # Difference array of a region, as one array of tile bases per tile
+        # allocated when a read first reaches it
+
+        def __init__(self, tile):
+                self.tile = tile
+                self.tiles = {}
+
+        def __getitem__(self, i):
+                d = self.tiles.get(i // self.tile)
+                return d[i % self.tile] if d is not None else 0
+
+        def __setitem__(self, i, v):
+                k = i // self.tile
+                if k not in self.tiles:
+                        self.tiles[k] = array("i", [0]) * self.tile
+                self.tiles[k][i % self.tile] = v
+
+        def pop(self, k):
+                return self.tiles.pop(k, None)
+
+
+class TiledRegionCoverage(RegionCoverage):
+        # Same as RegionCoverage for reads sorted by start, without a
+        # difference array of the whole region. The block boundaries of each
+        # tile are kept until the reads start after it, and then reduced to
+        # coverage runs. Junction counts are kept for the whole region
+
+        def __init__(self, c, s, tile):
+                self.chr, self.start, self.end = parse_coordinates(c)
+                self.s, self.tile = s, tile
+                strands = ["+"] if s == "NONE" else ["+", "-"]
+                self.d = dict((strand, TileEvents(tile)) for strand in strands)
+                self.junctions = dict((strand, OrderedDict()) for strand in strands)
+                # Runs of the tiles reduced so far, as offsets and coverage
+                self.runs = dict((strand, ([0], [0])) for strand in strands)
+                self.done = 0
+
+        def add(self, samflag, read_start, CIGAR):
+                self.flush(max(0, read_start - self.start) // self.tile)
+                RegionCoverage.add(self, samflag, read_start, CIGAR)
+
+        def flush(self, k):
+                # Reduce the tiles before tile k
+                n = self.end - self.start
+                for strand, d in self.d.items():
+                        x, y = self.runs[strand]
+                        for tile in range(self.done, k):
+                                events = d.pop(tile)
+                                if events is None:
+                                        continue
+                                first = tile * self.tile
+                                for i in range(min(self.tile, n - first)):
+                                        if not events[i]:
+                                                continue
+                                        if first + i == x[-1]:
+                                                y[-1] += events[i]
+                                        else:
+                                                x.append(first + i)
+                                                y.append(y[-1] + events[i])
+                self.done = max(self.done, k)
+
+        def result(self):
+                n = self.end - self.start
+                self.flush(n // self.tile + 1)
+                a = {}
+                for strand, (x, y) in self.runs.items():
+                        a[strand] = [self.start + i for i in x], y, [j - i for i, j in zip(x, x[1:] + [n])]
+                return a, self.junctions
+
+
+def region_coverage(c, s, tile=0):
+        # Regions longer than tile are accumulated tile by tile
+        _, start, end = parse_coordinates(c)
+        if tile and end - start > tile:
+                return TiledRegionCoverage(c, s, tile)
+        return RegionCoverage(c, s)
+
 
+def read_bam(f, c, s, reader="samtools", tile=0):
+        region = region_coverage(c, s, tile)
+        for _, samflag, read_start, CIGAR in BAM_READERS[reader](f, [c]):
+                region.add(samflag, read_start, CIGAR)
+        return region.result()
+
+
+def merge_regions(regions):
+        # Sorted union of overlapping or adjacent regions
+        merged = []
+        for chr, start, end in sorted(parse_coordinates(c) for c in regions):
+                if merged and merged[-1][0] == chr and start <= merged[-1][2]:
+                        merged[-1][2] = max(merged[-1][2], end)
+                else:
+                        merged.append([chr, start, end])
+        return ["%s:%s-%s" %(chr, start + 1, end) for chr, start, end in merged]
+
+
+def read_bam_regions(f, regions, s, reader="samtools", tile=0):
+        # Coverage and junctions of several regions from a single pass over
+        # the bam file. Each alignment goes to every region it overlaps
+        accumulators = [region_coverage(c, s, tile) for c in regions]
+        by_chr = {}
+        for region in sorted(accumulators, key=lambda r: r.start):
+                by_chr.setdefault(region.chr, []).append(region)
+        starts = dict((chr, [r.start for r in rs]) for chr, rs in by_chr.items())
+        maxlen = dict((chr, max(r.end - r.start for r in rs)) for chr, rs in by_chr.items())
+        for chr, samflag, read_start, CIGAR in BAM_READERS[reader](f, merge_regions(regions)):
+                if chr not in by_chr:
+                        continue
+                CIGAR = list(CIGAR)
+                # Last aligned base, as samtools computes it to select reads by region
+                read_end = read_start + max(1, sum(l for op, l in CIGAR if op in "MDN")) - 1
+                rs = by_chr[chr]
+                for i in range(bisect_left(starts[chr], read_start - maxlen[chr] - 1), bisect_left(starts[chr], read_end)):
+                        if rs[i].end >= read_start:
+                                rs[i].add(samflag, read_start, CIGAR)
+        return [region.result() for region in accumulators]
+
+
+READ_CACHE_MAGIC = b"GGSASHIMI_READ_CACHE_1\n"
+
+# Entries of the read cache kept in memory by each process
+READ_CACHE_MEMORY = 256
+
+
+def bam_index_mtime(f):
+        for index in (f + ".bai", re.sub(r"\.bam$", ".bai", f), f + ".csi"):
+                if os.path.isfile(index):
+                        return os.stat(index).st_mtime
+        return None
+
+
+class ReadCache(object):
+        # Coverage runs and junction counts of a bam file in a region, as
+        # returned by read_bam, stored as int32 vectors in one file per entry.
+        # Entries are keyed by the bam file and index, the region, the strand
+        # mode and the read filters, and the least recently used are removed
+        # when the cache grows over size bytes. The total size is kept in a
+        # file, so that the cache is only listed when it is over size. The
+        # entries of a process are also kept in memory, up to
+        # READ_CACHE_MEMORY of them
+
+        def __init__(self, path, size):
+                self.path, self.size = path, size
+                self.memory = OrderedDict()
+
+        # Processes reading in parallel start with an empty memory
+        def __getstate__(self):
+                return self.path, self.size
+
+        def __setstate__(self, state):
+                self.__init__(*state)
+
+        def sample_key(self, f, chr, s):
+                st = os.stat(f)
+                return json.dumps([os.path.abspath(f), st.st_size, st.st_mtime, bam_index_mtime(f), chr, s, SKIPPED_CIGAR_OPS])
+
+        def directory(self, sample_key):
+                # Entries of a bam file and chromosome share a directory named
+                # after the hash of their key, and are told apart by the region
+                return os.path.join(self.path, hashlib.md5(sample_key.encode('utf-8')).hexdigest())
+
+        def entry(self, sample_key, start, end):
+                return os.path.join(self.directory(sample_key), "%d_%d.reads" %(start, end))
+
+        def total(self):
+                # Running size of the entries. Updates of processes writing at
+                # the same time may be lost, which evict corrects
+                try:
+                        with open(os.path.join(self.path, "size")) as openf:
+                                return int(openf.read())
+                except (IOError, OSError, ValueError):
+                        return 0
+
+        def set_total(self, total):
+                path = os.path.join(self.path, "size")
+                tmp = "%s.%d.tmp" %(path, os.getpid())
+                with open(tmp, "w") as out:
+                        out.write("%d\n" % total)
+                os.rename(tmp, path)
+
+        def load(self, sample_key, start, end):
+                path = self.entry(sample_key, start, end)
+                key = json.dumps([sample_key, start, end])
+                if path in self.memory:
+                        result = self.memory.pop(path)
+                else:
+                        try:
+                                with open(path, "rb") as openf:
+                                        buf = openf.read()
+                        except (IOError, OSError):
+                                return None
+                        result = self.decode(buf, key)
+                        if result is None:
+                                return None
+                self.remember(path, result)
+                # Mark the entry as recently used
+                try:
+                        os.utime(path, None)
+                except OSError:
+                        pass
+                return result
+
+        def remember(self, path, result):
+                self.memory[path] = result
+                while len(self.memory) > READ_CACHE_MEMORY:
+                        self.memory.popitem(last=False)
+
+        def decode(self, buf, key):
+                if not buf.startswith(READ_CACHE_MAGIC):
+                        return None
+                nl = buf.find(b"\n", len(READ_CACHE_MAGIC))
+                size = int(buf[len(READ_CACHE_MAGIC):nl])
+                header = json.loads(buf[nl + 1:nl + 1 + size].decode('utf-8'))
+                if header["key"] != key:
+                        return None
+                offset = nl + 1 + size
+                a, junctions = {}, {}
+                for strand, n, k in header["strands"]:
+                        x, y, w = [int_view(buf, offset + 4*n*i, n).tolist() for i in range(3)]
+                        offset += 12*n
+                        dons, accs, counts = [int_view(buf, offset + 4*k*i, k).tolist() for i in range(3)]
+                        offset += 12*k
+                        a[strand] = x, y, w
+                        junctions[strand] = OrderedDict(zip(zip(dons, accs), counts))
+                return a, junctions
+
+        def get(self, f, c, s):
+                chr, start, end = parse_coordinates(c)
+                return self.load(self.sample_key(f, chr, s), start, end)
+
+        def put(self, f, c, s, result):
+                a, junctions = result
+                chr, start, end = parse_coordinates(c)
+                sample_key = self.sample_key(f, chr, s)
+                header = {"key": json.dumps([sample_key, start, end]), "strands": [[strand, len(a[strand][0]), len(junctions[strand])] for strand in a]}
+                blocks = []
+                for strand in a:
+                        blocks += [int_bytes(v) for v in a[strand]]
+                        blocks += [int_bytes([k[i] for k in junctions[strand]]) for i in range(2)]
+                        blocks.append(int_bytes(list(junctions[strand].values())))
+                header = json.dumps(header).encode('utf-8')
+                path = self.entry(sample_key, start, end)
+                if not os.path.isdir(os.path.dirname(path)):
+                        try:
+                                os.makedirs(os.path.dirname(path))
+                        except OSError:
+                                # Made by another process in the meantime
+                                pass
+                # Processes reading in parallel may write the same entry
+                tmp = "%s.%d.tmp" %(path, os.getpid())
+                with open(tmp, "wb") as out:
+                        out.write(READ_CACHE_MAGIC)
+                        out.write(("%d\n" % len(header)).encode('utf-8'))
+                        out.write(header)
+                        for b in blocks:
+                                out.write(b)
+                os.rename(tmp, path)
+                self.remember(path, result)
+                total = self.total() + os.path.getsize(path)
+                self.set_total(total)
+                if total > self.size:
+                        self.evict()
+
+        def regions(self, sample_key):
+                # Start and end of the cached regions of a bam file and chromosome
+                directory = self.directory(sample_key)
+                if not os.path.isdir(directory):
+                        return
+                for name in os.listdir(directory):
+                        if name.endswith(".reads"):
+                                start, end = name[:-len(".reads")].split("_")
+                                yield int(start), int(end)
+
+        def read(self, f, c, s, reader, tile=0):
+                # Same result as read_bam, reusing the cached region that
+                # overlaps c the most and reading the rest from the bam file
+                result = self.get(f, c, s)
+                if result is not None:
+                        return result
+                chr, start, end = parse_coordinates(c)
+                sample_key = self.sample_key(f, chr, s)
+                # Coverage runs start at the 1-based position start and
+                # junctions are counted when start < don and acc < end. The
+                # coverage of a region is then that of all the reads in
+                # [start + 1, end - 1], and the junction counts are those of all
+                # the reads. The first position only counts reads reaching
+                # into the region
+                overlaps = sorted((min(e, end) - max(b, start) - 1, b, e) for b, e in self.regions(sample_key))
+                cached = None
+                if overlaps and overlaps[-1][0] > 0:
+                        _, cached_start, cached_end = overlaps[-1]
+                        cached = self.load(sample_key, cached_start, cached_end)
+                if cached is None:
+                        result = read_bam(f, c, s, reader, tile)
+                        self.put(f, c, s, result)
+                        return result
+
+                # Positions [lo, hi) are taken from the cache. The reads of the
+                # rest of the region and of its first base are read from the
+                # bam file, and only their junctions outside the cached region
+                # are counted, so reads across the boundary are counted once
+                lo, hi = max(cached_start, start) + 1, min(cached_end, end)
+                fetch = ["%s:%d-%d" %(chr, start + 1, start + 1)]
+                if lo > start + 1:
+                        fetch.append("%s:%d-%d" %(chr, start + 1, lo - 1))
+                if hi < end:
+                        fetch.append("%s:%d-%d" %(chr, hi, end - 1))
+                region = region_coverage(c, s, tile)
+                for _, samflag, read_start, CIGAR in BAM_READERS[reader](f, merge_regions(fetch)):
+                        region.add(samflag, read_start, CIGAR)
+                fresh, fresh_junctions = region.result()
+                cached, cached_junctions = cached
+                a, junctions = {}, {}
+                for strand in fresh:
+                        a[strand] = join_runs([clip_runs(fresh[strand], start, lo), clip_runs(cached[strand], lo, hi), clip_runs(fresh[strand], hi, end)])
+                        junctions[strand] = OrderedDict(((don, acc), n) for (don, acc), n in cached_junctions[strand].items() if don > start and acc < end)
+                        for (don, acc), n in fresh_junctions[strand].items():
+                                if not (don > cached_start and acc < cached_end):
+                                        junctions[strand][(don, acc)] = n
+                result = a, junctions
+                self.put(f, c, s, result)
+                return result
+
+        def evict(self):
+                entries = []
+                for directory in os.listdir(self.path):
+                        if not os.path.isdir(os.path.join(self.path, directory)):
+                                continue
+                        for name in os.listdir(os.path.join(self.path, directory)):
+                                if not name.endswith(".reads"):
+                                        continue
+                                path = os.path.join(self.path, directory, name)
+                                try:
+                                        st = os.stat(path)
+                                except OSError:
+                                        continue
+                                entries.append((st.st_mtime, st.st_size, path))
+                total = sum(size for _, size, _ in entries)
+                for _, size, path in sorted(entries):
+                        if total <= self.size:
+                                break
+                        try:
+                                os.remove(path)
+                        except OSError:
+                                pass
+                        self.memory.pop(path, None)
+                        total -= size
+                self.set_total(total)
+
+
+def open_read_cache(args):
+        if not args.read_cache:
+                return None
+        return ReadCache(os.path.join(args.cache_dir, "reads"), args.read_cache_size * 2**20)
+
+
+STORE_SUFFIX = ".store"
+STORE_MAGIC = b"GGSASHIMI_STORE_2\n"
+STORE_FORMAT = 2
+
+# Bin sizes of the coarser levels of coverage in the stores
+STORE_LEVELS = (16, 256, 4096)
+
+
+def is_store(f):
+        return f.endswith(STORE_SUFFIX) and os.path.isdir(f)
+
+
+def store_manifest(store):
+        try:
+                with open(os.path.join(store, "store.json")) as openf:
+                        return json.load(openf)
+        except (IOError, OSError, ValueError):
+                return None
+
+
+def write_store_manifest(store, manifest):
+        tmp = os.path.join(store, "store.json.tmp")
+        with open(tmp, "w") as openf:
+                json.dump(manifest, openf)
+        os.rename(tmp, os.path.join(store, "store.json"))
+
+
+def bam_chromosomes(f, reader="samtools"):
+        # Names and lengths of the reference sequences in the bam header
+        if reader == "pysam":
+                bam = pysam.AlignmentFile(f, "rb")
+                chroms = list(zip(bam.references, bam.lengths))
+                bam.close()
+                return chroms
+        chroms = []
+        p = sp.Popen("samtools view -H %s" % f, shell=True, stdout=sp.PIPE)
+        for line in p.stdout:
+                fields = line.decode('utf8').strip().split("\t")
+                if fields[0] == "@SQ":
+                        tags = dict(field.split(":", 1) for field in fields[1:])
+                        chroms.append((tags["SN"], int(tags["LN"])))
         p.stdout.close()
+        p.wait()
+        return chroms
+
+
+def level_bins(x, y, w, size):
+        # Maximum, minimum and mean coverage of the bins of size bases of
+        # runs starting at 0 and covering a multiple of size
+        mx, mn, mean = [], [], []
+        fill = 0
+        for v, l in zip(y, w):
+                if fill:
+                        # Complete the bin started by the previous runs
+                        t = min(l, size - fill)
+                        bin_max, bin_min, bin_sum = max(bin_max, v), min(bin_min, v), bin_sum + v*t
+                        fill += t
+                        l -= t
+                        if fill < size:
+                                continue
+                        mx.append(bin_max)
+                        mn.append(bin_min)
+                        mean.append(bin_sum / float(size))
+                        fill = 0
+                n = l // size
+                mx.extend([v] * n)
+                mn.extend([v] * n)
+                mean.extend([float(v)] * n)
+                if l - n*size:
+                        bin_max, bin_min, bin_sum = v, v, v*(l - n*size)
+                        fill = l - n*size
+        return mx, mn, mean
+
+
+class ChunkWriter(object):
+        # Coverage of one strand of a chromosome, from the boundaries of the
+        # aligned blocks of reads sorted by start, written as the zlib
+        # compressed runs (start within the chunk and coverage) of each chunk
+        # of chunk bases, and for each of levels as the zlib compressed
+        # maximum, minimum and mean of its bins. Chunks of constant coverage
+        # are written as the uncompressed value, or nothing if it is 0. A
+        # chunk is written once the reads start after it
+
+        def __init__(self, chunk, levels=STORE_LEVELS):
+                self.chunk = chunk
+                self.events = {}
+                self.value = 0
+                self.blocks = []
+                self.levels = OrderedDict((size, []) for size in levels)
+
+        def add(self, pos, delta):
+                k = pos // self.chunk
+                events = self.events.setdefault(k, {})
+                events[pos - k*self.chunk] = events.get(pos - k*self.chunk, 0) + delta
+
+        def flush(self, k):
+                # Write the chunks before chunk k
+                while len(self.blocks) < k:
+                        events = self.events.pop(len(self.blocks), None)
+                        if events is None:
+                                self.constant(int_bytes([self.value]) if self.value else b"")
+                                continue
+                        x, y = [0], [self.value]
+                        for offset, delta in sorted(events.items()):
+                                if delta == 0:
+                                        continue
+                                self.value += delta
+                                if offset == x[-1]:
+                                        y[-1] = self.value
+                                else:
+                                        x.append(offset)
+                                        y.append(self.value)
+                        if len(x) == 1:
+                                self.constant(int_bytes(y))
+                                continue
+                        self.blocks.append(zlib.compress(int_bytes(x) + int_bytes(y)))
+                        w = [j - i for i, j in zip(x, x[1:] + [self.chunk])]
+                        for size, blocks in self.levels.items():
+                                mx, mn, mean = level_bins(x, y, w, size)
+                                blocks.append(zlib.compress(int_bytes(mx) + int_bytes(mn) + float_bytes(mean)))
+
+        def constant(self, b):
+                self.blocks.append(b)
+                for blocks in self.levels.values():
+                        blocks.append(b)
+
+
+def index_chromosome(f, chr, length, s, reader, chunk):
+        # Compressed coverage chunks and the junction table, sorted by donor
+        # and acceptor, of each strand of a chromosome, from one pass over its
+        # reads. Positions are counted as read_bam does
+        strands = ["+"] if s == "NONE" else ["+", "-"]
+        writers = dict((strand, ChunkWriter(chunk)) for strand in strands)
+        junctions = dict((strand, {}) for strand in strands)
+        for _, samflag, read_start, CIGAR in BAM_READERS[reader](f, ["%s:1-%d" %(chr, length)]):
+                for writer in writers.values():
+                        writer.flush(read_start // chunk)
+                strand = read_strand(s, samflag)
+                pos = read_start
+                for CIGAR_op, CIGAR_len in CIGAR:
+                        if CIGAR_op == "I" or CIGAR_op == "S":
+                                continue
+                        if CIGAR_op == "M":
+                                writers[strand].add(pos, 1)
+                                writers[strand].add(pos + CIGAR_len, -1)
+                        if CIGAR_op == "N":
+                                junctions[strand][(pos, pos + CIGAR_len)] = junctions[strand].get((pos, pos + CIGAR_len), 0) + 1
+                        pos += CIGAR_len
+        n = length // chunk + 1
+        for writer in writers.values():
+                writer.flush(n)
+        return [(strand, writers[strand].blocks, writers[strand].levels, sorted(junctions[strand].items())) for strand in strands]
+
+
+def write_store_chromosome(path, chr, length, chunk, strands):
+        # For each strand, the int32 vector of the offsets of the chunks
+        # followed by the chunks, at full resolution and at each level, and
+        # the int32 vectors of donors, acceptors and counts
+        header = {"chr": chr, "length": length, "chunk": chunk, "strands": []}
+        blocks = []
+        offset = 0
+        for strand, chunks, levels, junctions in strands:
+                h = {"strand": strand, "levels": {}}
+                for size, level_chunks in [(1, chunks)] + list(levels.items()):
+                        offsets = [offset + 4*(len(level_chunks) + 1)]
+                        for b in level_chunks:
+                                offsets.append(offsets[-1] + len(b))
+                        blocks.append(int_bytes(offsets))
+                        blocks += level_chunks
+                        h["levels"][str(size)] = [offset, len(level_chunks)]
+                        offset = offsets[-1]
+                junction_blocks = [int_bytes([j[0][i] for j in junctions]) for i in range(2)] + [int_bytes([n for _, n in junctions])]
+                blocks += junction_blocks
+                h["junctions"] = [offset, len(junctions)]
+                header["strands"].append(h)
+                offset += sum(len(b) for b in junction_blocks)
+        header = json.dumps(header).encode('utf-8')
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as out:
+                out.write(STORE_MAGIC)
+                out.write(("%d\n" % len(header)).encode('utf-8'))
+                out.write(header)
+                for b in blocks:
+                        out.write(b)
+        os.rename(tmp, path)
+
+
+def build_store(bam, store, s, reader, chunk):
+        # Coverage store of a bam file: a manifest and one file per
+        # chromosome. Chromosomes already written by an interrupted build of
+        # the same bam file, strand mode and chunk size are kept
+        t = time.time()
+        st = os.stat(bam)
+        manifest = {"bam": os.path.abspath(bam), "size": st.st_size, "mtime": st.st_mtime, "strand": s, "chunk": chunk, "format": STORE_FORMAT}
+        previous = store_manifest(store)
+        if previous is not None and previous.get("complete") and dict((k, previous[k]) for k in manifest) == manifest:
+                return store, "OK", 0.0
+        if not os.path.isdir(store):
+                os.makedirs(store)
+        stale = previous is None or dict((k, previous.get(k)) for k in manifest) != manifest
+        for name in os.listdir(store):
+                if stale or name.endswith(".tmp"):
+                        os.remove(os.path.join(store, name))
+        manifest["chromosomes"] = bam_chromosomes(bam, reader)
+        manifest["complete"] = False
+        write_store_manifest(store, manifest)
+        for i, (chr, length) in enumerate(manifest["chromosomes"]):
+                path = os.path.join(store, "%d.cov" % i)
+                if os.path.isfile(path):
+                        continue
+                write_store_chromosome(path, chr, length, chunk, index_chromosome(bam, chr, length, s, reader, chunk))
+        manifest["complete"] = True
+        write_store_manifest(store, manifest)
+        return store, "OK", time.time() - t
+
+
+def store_chunk(mm, offsets, k):
+        # Chunk k of a level, decompressed. Constant chunks are expanded to a
+        # single run or bin of their value, with a start of 0 for runs
+        buf = mm[offsets[k]:offsets[k + 1]]
+        if len(buf) > 4:
+                return zlib.decompress(buf)
+        return buf or int_bytes([0])
+
+
+def chunk_runs(buf, k, chunk):
+        if len(buf) == 4:
+                return [k*chunk], int_view(buf, 0, 1).tolist(), [chunk]
+        n = len(buf) // 8
+        x = [k*chunk + i for i in int_view(buf, 0, n)]
+        y = int_view(buf, 4*n, n).tolist()
+        w = [j - i for i, j in zip(x, x[1:] + [(k + 1)*chunk])]
+        return x, y, w
+
+
+def chunk_bins(buf, k, chunk, size, stat):
+        # Bins of a level as runs of size bases, with their max, min or mean
+        if len(buf) == 4:
+                return [k*chunk], int_view(buf, 0, 1).tolist(), [chunk]
+        n = len(buf) // 12
+        if stat == "mean":
+                y = float_view(buf, 8*n, n).tolist()
+        else:
+                y = int_view(buf, 4*n*["max", "min"].index(stat), n).tolist()
+        return [k*chunk + i*size for i in range(n)], y, [size] * n
+
+
+def read_store(store, c, s, level=None):
+        # Same result as read_bam for a region, from a coverage store. The
+        # chunks overlapping the region are decompressed and the junctions
+        # found by binary search on the donors. With level, a bin size and
+        # one of max, min or mean, the coverage is that of the bins of the
+        # level, except at the junction anchors where it stays exact
+        chr, start, end = parse_coordinates(c)
+        manifest = store_manifest(store)
+        names = [name for name, _ in manifest["chromosomes"]]
+        strands = ["+"] if s == "NONE" else ["+", "-"]
+        a = dict((strand, ([start], [0], [end - start])) for strand in strands)
+        junctions = dict((strand, OrderedDict()) for strand in strands)
+        if chr not in names:
+                return a, junctions
+        with open(os.path.join(store, "%d.cov" % names.index(chr)), "rb") as openf:
+                mm = mmap.mmap(openf.fileno(), 0, access=mmap.ACCESS_READ)
+        nl = mm.find(b"\n", len(STORE_MAGIC))
+        size = int(mm[len(STORE_MAGIC):nl])
+        header = json.loads(mm[nl + 1:nl + 1 + size].decode('utf-8'))
+        data, chunk = nl + 1 + size, header["chunk"]
+        first = start // chunk
+        for h in header["strands"]:
+                strand = h["strand"]
+                offset, n = h["junctions"]
+                dons, accs, counts = (int_view(mm, data + offset + 4*n*i, n) for i in range(3))
+                for i in range(bisect_right(dons, start), bisect_left(dons, end)):
+                        if accs[i] < end:
+                                junctions[strand][(dons[i], accs[i])] = counts[i]
+
+                offset, nchunks = h["levels"]["1"]
+                offsets = [data + o for o in int_view(mm, data + offset, nchunks + 1)]
+                last = min((end - 1) // chunk + 1, nchunks)
+                if level is None:
+                        pieces = [chunk_runs(store_chunk(mm, offsets, k), k, chunk) for k in range(first, last)]
+                else:
+                        bin_size, stat = level
+                        offset, _ = h["levels"][str(bin_size)]
+                        level_offsets = [data + o for o in int_view(mm, data + offset, nchunks + 1)]
+                        pieces = [chunk_bins(store_chunk(mm, level_offsets, k), k, chunk, bin_size, stat) for k in range(first, last)]
+                # No coverage past the last chunk
+                pieces = [clip_runs(piece, start, end) for piece in pieces]
+                if max(start, last*chunk) < end:
+                        pieces.append(([max(start, last*chunk)], [0], [end - max(start, last*chunk)]))
+                x, y, w = join_runs(pieces)
+
+                if level is not None:
+                        # Exact coverage at the anchors of the junctions
+                        anchors = set(don - 1 for don, _ in junctions[strand]) | set(acc + 1 for _, acc in junctions[strand])
+                        anchors = sorted(p for p in anchors if start <= p < end and p < nchunks*chunk)
+                        x, y, w = split_runs(x, y, w, anchors)
+                        exact = {}
+                        for p in anchors:
+                                k = p // chunk
+                                if k not in exact:
+                                        exact[k] = chunk_runs(store_chunk(mm, offsets, k), k, chunk)
+                                y[bisect_left(x, p)] = run_value(exact[k], p)
+                a[strand] = x, y, w
         return a, junctions
 
+
 def get_bam_path(index, path):
         if os.path.isabs(path):
                 return path
@@ -168,6 +1113,11 @@ def get_bam_path(index, path):
         return os.path.join(base_dir, path)
 
 def read_bam_input(f, overlay, color, label):
+        if is_store(f.rstrip("/")):
+                f = f.rstrip("/")
+                bn = os.path.basename(f)[:-len(STORE_SUFFIX)]
+                yield bn, f, None, None, bn
+                return
         if f.endswith(".bam"):
                 bn = f.strip().split("/")[-1].strip(".bam")
                 yield bn, f, None, None, bn
@@ -182,13 +1132,10 @@ def read_bam_input(f, overlay, color, label):
                         yield line_sp[0], bam, overlay_level, color_level, label_text
 
 
-def prepare_for_R(a, junctions, c, m):
-
-        _, start, _ = parse_coordinates(args.coordinates)
+def prepare_for_R(a, junctions, m):
 
-        # Convert the array index to genomic coordinates
-        x = list(i+start for i in range(len(a)))
-        y = a
+        # Coverage runs in genomic coordinates
+        x, y, w = a
 
         # Arrays for R
         dons, accs, yd, ya, counts = [], [], [], [], []
@@ -204,10 +1151,84 @@ def prepare_for_R(a, junctions, c, m):
                 accs.append(acc)
                 counts.append(n)
 
-                yd.append( a[ don - start -1 ])
-                ya.append( a[ acc - start +1 ])
+                yd.append( run_value(a, don - 1) )
+                ya.append( run_value(a, acc + 1) )
 
-        return x, y, dons, accs, yd, ya, counts
+        return x, y, dons, accs, yd, ya, counts, w
+
+
+def prepare_sample(a, junctions, m):
+        if a.keys() == ["+"] and all(map(lambda x: x==0, list(a.values())[0][1])):
+                return None, None
+        return junctions, OrderedDict((strand, prepare_for_R(a[strand], junctions[strand], m)) for strand in a)
+
+
+def read_sample(bam, c, s, reader, m, cache=None, level=None, tile=0):
+        if is_store(bam):
+                a, junctions = read_store(bam, c, s, level)
+        elif cache is not None:
+                a, junctions = cache.read(bam, c, s, reader, tile)
+        else:
+                a, junctions = read_bam(bam, c, s, reader, tile)
+        return prepare_sample(a, junctions, m)
+
+
+def read_sample_regions(bam, regions, s, reader, m, cache=None, levels=None, tile=0):
+        # Regions that cannot be read are returned as an IOError, so that the
+        # rest of a batch is still plotted
+        if is_store(bam):
+                levels = levels or [None] * len(regions)
+                results = []
+                for c, level in zip(regions, levels):
+                        try:
+                                results.append(read_store(bam, c, s, level))
+                        except Exception as e:
+                                results.append(IOError("%s: %s" %(bam, e)))
+        else:
+                # Only the regions missing from the cache are read from the bam file
+                results = [cache.get(bam, c, s) if cache is not None else None for c in regions]
+                missing = [c for c, result in zip(regions, results) if result is None]
+                if missing:
+                        try:
+                                fresh = read_bam_regions(bam, missing, s, reader, tile)
+                        except Exception:
+                                # Read the regions one at a time to tell the failing ones
+                                fresh = []
+                                for c in missing:
+                                        try:
+                                                fresh.append(read_bam(bam, c, s, reader, tile))
+                                        except Exception as e:
+                                                fresh.append(IOError("%s: %s" %(bam, e)))
+                        read = iter(fresh)
+                        for i, c in enumerate(regions):
+                                if results[i] is None:
+                                        results[i] = next(read)
+                                        if cache is not None and not isinstance(results[i], IOError):
+                                                cache.put(bam, c, s, results[i])
+        return [result if isinstance(result, IOError) else prepare_sample(result[0], result[1], m) for result in results]
+
+
+def parallel_map(f, tasks, jobs=1):
+        # Yield f(*task) for each task in order. At most 2*jobs tasks are
+        # in flight, so memory is bounded by the number of workers
+        if jobs <= 1:
+                for task in tasks:
+                        yield f(*task)
+                return
+        pool = mp.Pool(jobs)
+        pending = deque()
+        try:
+                for task in tasks:
+                        pending.append(pool.apply_async(f, task))
+                        if len(pending) >= 2 * jobs:
+                                yield pending.popleft().get()
+                while pending:
+                        yield pending.popleft().get()
+        except:
+                pool.terminate()
+                raise
+        pool.close()
+        pool.join()
 
 
 def intersect_introns(data):
@@ -226,44 +1247,145 @@ def intersect_introns(data):
 
 
 
-def shrink_density(x, y, introns):
-        new_x, new_y = [], []
-        shift = 0
-        start = 0
-        # introns are already sorted by coordinates
-        for a,b in introns:
-                end = x.index(a)+1
-                new_x += [int(i-shift) for i in x[start:end]]
-                new_y += y[start:end]
-                start = x.index(b)
-                l = (b-a)
-                shift += l-l**0.7
-        new_x += [int(i-shift) for i in x[start:]]
-        new_y += y[start:]
-        return new_x, new_y
-
-def shrink_junctions(dons, accs, introns):
-        new_dons, new_accs = [0]*len(dons), [0]*len(accs)
-        real_introns = dict()
-        shift_acc = 0
-        shift_don = 0
-        s = set()
-        junctions = list(zip(dons, accs))
+def shrink_table(introns):
+        # Shifts applied by --shrink, computed once per plot from the sorted
+        # intersected introns. Positions after the k-th intron move left by
+        # density_shifts[k+1] in the coverage and junction_shifts[k+1] in the
+        # junctions and on the axis
+        density_shifts, junction_shifts = [0], [0]
         for a,b in introns:
                 l = b - a
-                shift_acc += l-int(l**0.7)
-                real_introns[a - shift_don] = a
-                real_introns[b - shift_acc] = b
-                for i, (don, acc) in enumerate(junctions):
-                        if a >= don and b <= acc:
-                                if (don,acc) not in s:
-                                        new_dons[i] = don - shift_don
-                                        new_accs[i] = acc - shift_acc
-                                else:
-                                        new_accs[i] = acc - shift_acc
-                                s.add((don,acc))
-                shift_don = shift_acc
-        return real_introns, new_dons, new_accs
+                density_shifts.append(density_shifts[-1] + l-l**0.7)
+                junction_shifts.append(junction_shifts[-1] + l-int(l**0.7))
+        return {
+                "introns": introns,
+                "starts": [a for a,b in introns],
+                "ends": [b for a,b in introns],
+                "density_shifts": density_shifts,
+                "junction_shifts": junction_shifts,
+        }
+
+
+def shrink_density(x, y, w, table):
+        # Keep the coverage runs outside the intersected introns, moving the
+        # segment after each intron left. Positions in a segment move by the
+        # same integer amount, so runs stay runs
+        new_x, new_y, new_w = [], [], []
+        segments = list(zip([None] + table["ends"], table["starts"] + [None], table["density_shifts"]))
+        k = 0
+        for run_start, v, l in zip(x, y, w):
+                run_last = run_start + l - 1
+                # introns are already sorted by coordinates, as are the runs
+                while segments[k][1] is not None and segments[k][1] < run_start:
+                        k += 1
+                for seg_first, seg_last, shift in segments[k:]:
+                        first = run_start if seg_first is None else max(seg_first, run_start)
+                        last = run_last if seg_last is None else min(seg_last, run_last)
+                        if first > run_last:
+                                break
+                        if first <= last:
+                                new_x.append(int(first-shift))
+                                new_y.append(v)
+                                new_w.append(last - first + 1)
+        return new_x, new_y, new_w
+
+def shrink_junctions(dons, accs, table):
+        new_dons, new_accs = [0]*len(dons), [0]*len(accs)
+        shifts = table["junction_shifts"]
+        for i, (don, acc) in enumerate(zip(dons, accs)):
+                # The introns spanned by a junction are consecutive
+                first, last = bisect_left(table["starts"], don), bisect_right(table["ends"], acc)
+                if first < last:
+                        new_dons[i] = don - shifts[first]
+                        new_accs[i] = acc - shifts[last]
+        return new_dons, new_accs
+
+
+def extended_breaks(dmin, dmax, m, Q=(1, 5, 2, 2.5, 4, 3), w=(0.25, 0.2, 0.5, 0.05)):
+        # Axis breaks by the extended Wilkinson algorithm of Talbot et al.,
+        # as computed by labeling::extended in R
+        eps = 2.220446e-16 * 100
+        dmin, dmax = min(dmin, dmax), max(dmin, dmax)
+        if dmax - dmin < eps:
+                return [dmin + i * (dmax - dmin) / (m - 1.) for i in range(m)]
+
+        def density(k, lmin, lmax):
+                r = (k - 1.) / (lmax - lmin)
+                rt = (m - 1.) / (max(lmax, dmax) - min(dmin, lmin))
+                return 2 - max(r / rt, rt / r)
+
+        def coverage(lmin, lmax):
+                return 1 - 0.5 * ((dmax - lmax)**2 + (dmin - lmin)**2) / (0.1 * (dmax - dmin))**2
+
+        def coverage_max(span):
+                if span <= dmax - dmin:
+                        return 1
+                half = (span - (dmax - dmin)) / 2.
+                return 1 - half**2 / (0.1 * (dmax - dmin))**2
+
+        best, best_score = None, -2
+        j = 1
+        while True:
+                for i, q in enumerate(Q):
+                        sm = 1 - i / (len(Q) - 1.) - j + 1
+                        if w[0]*sm + w[1] + w[2] + w[3] < best_score:
+                                return [best[0] + i * best[2] for i in range(int(round((best[1] - best[0]) / best[2])) + 1)]
+                        k = 2
+                        while True:
+                                dm = 2 - (k - 1.) / (m - 1) if k >= m else 1
+                                if w[0]*sm + w[1] + w[2]*dm + w[3] < best_score:
+                                        break
+                                delta = (dmax - dmin) / (k + 1.) / j / q
+                                z = int(math.ceil(math.log10(delta)))
+                                while True:
+                                        step = j * q * 10.**z
+                                        cm = coverage_max(step * (k - 1))
+                                        if w[0]*sm + w[1]*cm + w[2]*dm + w[3] < best_score:
+                                                break
+                                        min_start = int(math.floor(dmax / step)) * j - (k - 1) * j
+                                        max_start = int(math.ceil(dmin / step)) * j
+                                        for start in range(min_start, max_start + 1):
+                                                lmin = start * (step / j)
+                                                lmax = lmin + step * (k - 1)
+                                                v = 1 if (lmin % step < eps or step - lmin % step < eps) and lmin <= 0 <= lmax else 0
+                                                score = w[0] * (sm - 1 + v) + w[1] * coverage(lmin, lmax) + \
+                                                        w[2] * density(k, lmin, lmax) + w[3]
+                                                if score > best_score:
+                                                        best, best_score = (lmin, lmax, step), score
+                                        z += 1
+                                k += 1
+                j += 1
+
+
+def shrink_breaks(table, tracks, m=5):
+        # Axis breaks of a shrunk plot, in shrunk coordinates, and their
+        # labels in real coordinates. Breaks inside a shrunk intron are
+        # interpolated across it, the others move back by the shift of the
+        # preceding intron. Breaks before the first or after the last intron
+        # are dropped unless they fall on the coverage
+        runs = [run for x, _, w in tracks for run in zip(x, w)]
+        x_min = min(x for x, l in runs)
+        x_max = max(x + l - 1 for x, l in runs)
+        shifts = table["junction_shifts"]
+        introns = [(a - shifts[k], b - shifts[k+1], a, b) for k, (a, b) in enumerate(table["introns"])]
+        breaks, labels = [], []
+        for b in extended_breaks(x_min, x_max, m):
+                inside = [i for i in introns if i[0] <= b <= i[1]]
+                if inside:
+                        shrinked_x, shrinked_xend, real_x, real_xend = inside[0]
+                        p = (b - shrinked_x) / float(shrinked_xend - shrinked_x)
+                        breaks.append(b)
+                        labels.append(R_round(real_x + p*(real_xend - real_x)))
+                        continue
+                # Number of introns before the break
+                k = bisect_right([i[1] for i in introns], b)
+                if introns and (k == 0 or k == len(introns)) and \
+                                not any(x <= b < x + l for x, l in runs):
+                        continue
+                breaks.append(b)
+                labels.append(b + shifts[k])
+        return breaks, labels
+
 
 def read_palette(f):
         palette = "#ff0000", "#00ff00", "#0000ff", "#000000"
@@ -273,57 +1395,357 @@ def read_palette(f):
         return palette
 
 
-def read_gtf(f, c):
+# Suffix of the bgzipped and tabix-indexed copy of a GTF made by index_gtf
+GTF_INDEX_SUFFIX = ".bgz"
+
+
+def is_indexed(f):
+        return f.endswith((".gz", GTF_INDEX_SUFFIX)) and any(os.path.isfile(f + ext) for ext in (".tbi", ".csi"))
+
+
+def index_gtf(f):
+        # Make a bgzipped, tabix-indexed copy of the GTF on first use. Records
+        # are sorted by position and the original line number is appended as
+        # an extra column, so that read_gtf can return them in file order
+        if is_indexed(f):
+                return f
+        bgz = f + GTF_INDEX_SUFFIX
+        if is_indexed(bgz) and os.path.getmtime(bgz) >= os.path.getmtime(f):
+                return bgz
+        tmp = bgz + ".tmp"
+        sp.check_call("awk -F '\\t' -v OFS='\\t' '!/^#/ {print $0, NR}' %s | sort -s -t \"$(printf '\\t')\" -k1,1 -k4,4n > %s" %(f, tmp), shell=True)
+        if pysam is not None:
+                pysam.tabix_compress(tmp, bgz, force=True)
+                pysam.tabix_index(bgz, preset="gff", force=True)
+        else:
+                sp.check_call("bgzip -c %s > %s && tabix -f -p gff %s" %(tmp, bgz, bgz), shell=True)
+        os.remove(tmp)
+        return bgz
+
+
+def tabix_lines(f, chr, start, end):
+        if pysam is not None:
+                tbx = pysam.TabixFile(f)
+                lines = list(tbx.fetch(chr, start, end)) if chr in tbx.contigs else []
+                tbx.close()
+                return lines
+        p = sp.Popen("tabix %s %s:%s-%s" %(f, chr, start + 1, end), shell=True, stdout=sp.PIPE)
+        lines = [line.decode('utf8') for line in p.stdout]
+        p.stdout.close()
+        p.wait()
+        return lines
+
+
+def gtf_lines(f, chr, start, end):
+        # All the GTF lines, or only those overlapping the region if the GTF is indexed
+        if not is_indexed(f):
+                with open(f) as openf:
+                        for line in openf:
+                                yield line
+                return
+        lines = tabix_lines(f, chr, start, end)
+        if f.endswith(GTF_INDEX_SUFFIX):
+                lines.sort(key=lambda line: int(line.strip().split("\t")[9]))
+        for line in lines:
+                yield line
+
+
+def gtf_records(f, chr, start, end):
+        # Feature, transcript id, 0-based start, end and strand of the GTF lines on chr
+        for line in gtf_lines(f, chr, start, end):
+                if line.startswith("#"):
+                        continue
+                el_chr, _, el, el_start, el_end, _, strand, _, tags = line.strip().split("\t")[:9]
+                if el_chr != chr:
+                        continue
+                d = dict(kv.strip().split(" ") for kv in tags.strip(";").split("; "))
+                yield el, d["transcript_id"], int(el_start) -1, int(el_end), strand
+
+
+GTF_CACHE_MAGIC = b"GGSASHIMI_GTF_CACHE_2\n"
+
+# Attributes whose values can be looked up as coordinates
+GTF_NAME_KEYS = ("gene_name", "gene_id", "transcript_name", "transcript_id")
+
+
+def int_view(buf, offset, n):
+        # Read-only int32 vector over a buffer, without copying it when possible
+        try:
+                return memoryview(buf)[offset:offset + 4*n].cast("i")
+        except (AttributeError, TypeError):
+                # python 2: no cast(), and mmap has no buffer interface
+                return array("i", buf[offset:offset + 4*n])
+
+
+def int_bytes(values):
+        a = array("i", values)
+        return a.tobytes() if hasattr(a, "tobytes") else a.tostring()
+
+
+def float_view(buf, offset, n):
+        try:
+                return memoryview(buf)[offset:offset + 4*n].cast("f")
+        except (AttributeError, TypeError):
+                # python 2
+                return array("f", buf[offset:offset + 4*n])
+
+
+def float_bytes(values):
+        a = array("f", values)
+        return a.tobytes() if hasattr(a, "tobytes") else a.tostring()
+
+
+def write_gtf_cache(f, path):
+        # Transcript and exon records of each chromosome sorted by start, stored
+        # as int32 vectors of starts, ends, file order and transcript index,
+        # plus byte vectors of feature type and strand and the transcript ids.
+        # Gene and transcript names and ids are stored sorted with the span
+        # of their records
+        chroms = OrderedDict()
+        names = dict()
+        if f.endswith((".gz", GTF_INDEX_SUFFIX)):
+                openf = codecs.getreader('utf-8')(gzip.open(f))
+        else:
+                openf = codecs.open(f, encoding='utf-8')
+        for n, line in enumerate(openf):
+                if line.startswith("#"):
+                        continue
+                fields = line.strip().split("\t")
+                el_chr, _, el, el_start, el_end, _, strand, _, tags = fields[:9]
+                d = dict(kv.strip().split(" ") for kv in tags.strip(";").split("; "))
+                for key in GTF_NAME_KEYS:
+                        if key in d:
+                                name_chr, name_start, name_end = names.setdefault(d[key].strip('"'), (el_chr, int(el_start) -1, int(el_end)))
+                                if name_chr == el_chr:
+                                        names[d[key].strip('"')] = name_chr, min(name_start, int(el_start) -1), max(name_end, int(el_end))
+                if el not in ("transcript", "exon"):
+                        continue
+                records, tx_ids = chroms.setdefault(el_chr, ([], OrderedDict()))
+                tx = tx_ids.setdefault(d["transcript_id"], len(tx_ids))
+                # Copies made by index_gtf carry the original line number
+                order = int(fields[9]) if len(fields) > 9 else n
+                records.append((int(el_start) -1, int(el_end), order, tx, el[0], strand))
+        openf.close()
+
+        st = os.stat(f)
+        header = {"size": st.st_size, "mtime": st.st_mtime, "chroms": {}}
+        blocks = []
+        offset = 0
+        for chr, (records, tx_ids) in chroms.items():
+                records.sort()
+                starts, ends, order, tx, kinds, strands = zip(*records)
+                chr_blocks = [int_bytes(v) for v in (starts, ends, order, tx)]
+                chr_blocks += [v.encode('utf-8') for v in ("".join(kinds), "".join(strands), "\n".join(tx_ids))]
+                offsets = [offset]
+                for b in chr_blocks:
+                        offsets.append(offsets[-1] + len(b))
+                header["chroms"][chr] = {
+                        "n": len(records),
+                        "maxlen": max(e - s for s, e in zip(starts, ends)),
+                        "offsets": offsets,
+                }
+                offset = offsets[-1]
+                blocks += chr_blocks
+
+        keys = sorted(name.encode('utf-8') for name in names)
+        regions = [names[key.decode('utf-8')] for key in keys]
+        chr_names = sorted(set(r[0] for r in regions))
+        name_offsets = [0]
+        for key in keys:
+                name_offsets.append(name_offsets[-1] + len(key))
+        name_blocks = [int_bytes(name_offsets), b"".join(keys)]
+        name_blocks += [int_bytes(v) for v in zip(*((chr_names.index(c), s, e) for c, s, e in regions))] if regions else [b"", b"", b""]
+        offsets = [offset]
+        for b in name_blocks:
+                offsets.append(offsets[-1] + len(b))
+        header["names"] = {"n": len(keys), "chroms": chr_names, "offsets": offsets}
+        blocks += name_blocks
+
+        header = json.dumps(header).encode('utf-8')
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as out:
+                out.write(GTF_CACHE_MAGIC)
+                out.write(("%d\n" % len(header)).encode('utf-8'))
+                out.write(header)
+                for b in blocks:
+                        out.write(b)
+        os.rename(tmp, path)
+
+
+class AnnotationCache(object):
+        # Memory-mapped cache written by write_gtf_cache, answering overlap
+        # queries by binary search on the sorted starts
+
+        def __init__(self, path, f):
+                self.path, self.f = path, f
+                self.header = None
+                with open(path, "rb") as openf:
+                        self.mm = mmap.mmap(openf.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.mm[:len(GTF_CACHE_MAGIC)] != GTF_CACHE_MAGIC:
+                        return
+                nl = self.mm.find(b"\n", len(GTF_CACHE_MAGIC))
+                size = int(self.mm[len(GTF_CACHE_MAGIC):nl])
+                header = json.loads(self.mm[nl + 1:nl + 1 + size].decode('utf-8'))
+                st = os.stat(f)
+                if header["size"] != st.st_size or header["mtime"] != st.st_mtime:
+                        return
+                self.header = header
+                self.data = nl + 1 + size
+
+        def valid(self):
+                return self.header is not None
+
+        # Processes of a batch map the cache again instead of copying it
+        def __getstate__(self):
+                return self.path, self.f
+
+        def __setstate__(self, state):
+                self.__init__(*state)
+
+        def query(self, chr, start, end):
+                # Same records as gtf_records for transcripts and exons overlapping the region
+                c = self.header["chroms"].get(chr)
+                if c is None:
+                        return []
+                n, o = c["n"], [self.data + offset for offset in c["offsets"]]
+                starts, ends, order, tx = (int_view(self.mm, o[i], n) for i in range(4))
+                lo, hi = bisect_left(starts, start - c["maxlen"]), bisect_left(starts, end)
+                hits = sorted((order[i], i) for i in range(lo, hi) if ends[i] > start)
+                if not hits:
+                        return []
+                kinds = self.mm[o[4]:o[5]].decode('utf-8')
+                strands = self.mm[o[5]:o[6]].decode('utf-8')
+                tx_ids = self.mm[o[6]:o[7]].decode('utf-8').split("\n")
+                return [({"t": "transcript", "e": "exon"}[kinds[i]], tx_ids[tx[i]], starts[i], ends[i], strands[i]) for _, i in hits]
+
+        def lookup(self, name):
+                # Chromosome, 0-based start and end of a gene or transcript, by
+                # binary search on the sorted names
+                c = self.header["names"]
+                n, o = c["n"], [self.data + offset for offset in c["offsets"]]
+                name_offsets = int_view(self.mm, o[0], n + 1)
+                key = name.encode('utf-8')
+                lo, hi = 0, n
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.mm[o[1] + name_offsets[mid]:o[1] + name_offsets[mid + 1]] < key:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                if lo == n or self.mm[o[1] + name_offsets[lo]:o[1] + name_offsets[lo + 1]] != key:
+                        return None
+                chroms, starts, ends = (int_view(self.mm, o[i], n) for i in range(2, 5))
+                return c["chroms"][chroms[lo]], starts[lo], ends[lo]
+
+
+def load_annotation_cache(f, cache_dir=None):
+        if cache_dir is None:
+                path = f + ".cache"
+        else:
+                path = os.path.join(cache_dir, hashlib.md5(os.path.abspath(f).encode('utf-8')).hexdigest() + ".gtf.cache")
+        t = time.time()
+        cache = AnnotationCache(path, f) if os.path.isfile(path) else None
+        if cache is not None and cache.valid():
+                sys.stderr.write("Annotation cache loaded in %.3f s (warm start)\n" %(time.time() - t))
+                return cache
+        try:
+                if cache_dir is not None and not os.path.isdir(cache_dir):
+                        os.makedirs(cache_dir)
+                write_gtf_cache(f, path)
+        except (IOError, OSError) as e:
+                # The gtf file is parsed directly when the cache cannot be written
+                sys.stderr.write("WARNING: Could not write the annotation cache '%s' (%s)\n" %(path, e))
+                if os.path.isfile(path + ".tmp"):
+                        os.remove(path + ".tmp")
+                return None
+        cache = AnnotationCache(path, f)
+        sys.stderr.write("Annotation cache built in %.3f s (cold start)\n" %(time.time() - t))
+        return cache
+
+
+def lookup_gtf(f, name):
+        # Chromosome, 0-based start and end of a gene or transcript, parsing
+        # the gtf file as write_gtf_cache does
+        region = None
+        if f.endswith((".gz", GTF_INDEX_SUFFIX)):
+                openf = codecs.getreader('utf-8')(gzip.open(f))
+        else:
+                openf = codecs.open(f, encoding='utf-8')
+        for line in openf:
+                if line.startswith("#"):
+                        continue
+                el_chr, _, _, el_start, el_end, _, _, _, tags = line.strip().split("\t")[:9]
+                d = dict(kv.strip().split(" ") for kv in tags.strip(";").split("; "))
+                if not any(d.get(key, "").strip('"') == name for key in GTF_NAME_KEYS):
+                        continue
+                if region is None:
+                        region = el_chr, int(el_start) -1, int(el_end)
+                elif region[0] == el_chr:
+                        region = el_chr, min(region[1], int(el_start) -1), max(region[2], int(el_end))
+        openf.close()
+        return region
+
+
+def read_gtf(f, c, cache=None):
         exons = OrderedDict()
         transcripts = OrderedDict()
         chr, start, end = parse_coordinates(c)
+        if cache is not None:
+                records = cache.query(chr, start, end)
+        else:
+                records = gtf_records(f, chr, start, end)
         end = end -1
-        with open(f) as openf:
-                for line in openf:
-                        if line.startswith("#"):
-                                continue
-                        el_chr, _, el, el_start, el_end, _, strand, _, tags = line.strip().split("\t")
-                        if el_chr != chr:
-                                continue
-                        d = dict(kv.strip().split(" ") for kv in tags.strip(";").split("; "))
-                        transcript_id = d["transcript_id"]
-                        el_start, el_end = int(el_start) -1, int(el_end)
-                        strand = '"' + strand + '"'
-                        if el == "transcript":
-                                if (el_end > start and el_start < end):
-                                        transcripts[transcript_id] = max(start, el_start), min(end, el_end), strand
-                                continue
-                        if el == "exon":
-                                if (start < el_start < end or start < el_end < end):
-                                        exons.setdefault(transcript_id, []).append((max(el_start, start), min(end, el_end), strand))
+        for el, transcript_id, el_start, el_end, strand in records:
+                strand = '"' + strand + '"'
+                if el == "transcript":
+                        if (el_end > start and el_start < end):
+                                transcripts[transcript_id] = max(start, el_start), min(end, el_end), strand
+                        continue
+                if el == "exon":
+                        if (start < el_start < end or start < el_end < end):
+                                exons.setdefault(transcript_id, []).append((max(el_start, start), min(end, el_end), strand))
 
         return transcripts, exons
 
 
-def make_introns(transcripts, exons, intersected_introns=None):
-        new_transcripts = copy.deepcopy(transcripts)
-        new_exons = copy.deepcopy(exons)
+def make_introns(transcripts, exons, shrink=None):
+        new_transcripts, new_exons = transcripts, exons
         introns = OrderedDict()
-        if intersected_introns:
-                for tx, (tx_start,tx_end,strand) in new_transcripts.items():
-                        total_shift = 0
-                        for a,b in intersected_introns:
+        if shrink:
+                new_transcripts, new_exons = OrderedDict(), OrderedDict(exons)
+                starts, ends, shifts = shrink["starts"], shrink["ends"], shrink["junction_shifts"]
+                for tx, (tx_start,tx_end,strand) in transcripts.items():
+                        tx_exons = exons.get(tx, [])
+                        # Exon starts move by the introns starting before them,
+                        # exon ends by the introns ending before them
+                        moved = [[exon_start - shifts[bisect_left(starts, exon_start)], exon_end - shifts[bisect_right(ends, exon_end)]] for exon_start, exon_end, _ in tx_exons]
+                        total_shift = shifts[-1]
+                        # An intron containing a whole exon shifts that exon and the
+                        # exons listed after it by the distance to the exon instead
+                        contained = set()
+                        for exon_start, exon_end, _ in tx_exons:
+                                k = bisect_left(starts, exon_start) - 1
+                                if k >= 0 and ends[k] > exon_end:
+                                        contained.add(k)
+                        for k in contained:
+                                a, b = shrink["introns"][k]
                                 l = b - a
                                 shift = l - int(l**0.7)
-                                total_shift += shift
-                                for i, (exon_start,exon_end,strand) in enumerate(exons.get(tx,[])):
-                                        new_exon_start, new_exon_end = new_exons[tx][i][:2]
+                                for i, (exon_start, exon_end, _) in enumerate(tx_exons):
                                         if a < exon_start:
+                                                moved[i][0] += shifts[k+1] - shifts[k]
                                                 if b > exon_end:
-                                                        if i ==  len(exons[tx])-1:
+                                                        if i == len(tx_exons)-1:
                                                                 total_shift = total_shift - shift + (exon_start - a)*(1-int(l**-0.3))
                                                         shift = (exon_start - a)*(1-int(l**-0.3))
-                                                        new_exon_end = new_exons[tx][i][1] - shift
-                                                new_exon_start = new_exons[tx][i][0] - shift
+                                                        moved[i][1] -= shift
+                                                moved[i][0] -= shift
                                         if b <= exon_end:
-                                                new_exon_end = new_exons[tx][i][1] - shift
-                                        new_exons[tx][i] = (new_exon_start,new_exon_end,strand)
-                        tx_start = min(tx_start, sorted(new_exons.get(tx, [[sys.maxsize]]))[0][0])
+                                                moved[i][1] += shifts[k+1] - shifts[k] - shift
+                        if tx_exons:
+                                new_exons[tx] = [(exon_start, exon_end, exon_strand) for (exon_start, exon_end), (_, _, exon_strand) in zip(moved, tx_exons)]
+                                tx_start = min([tx_start] + [exon_start for exon_start, _ in moved])
+                                strand = tx_exons[-1][2]
                         new_transcripts[tx] = (tx_start, tx_end - total_shift, strand)
 
         for tx, (tx_start,tx_end,strand) in new_transcripts.items():
@@ -340,8 +1762,42 @@ def make_introns(transcripts, exons, intersected_introns=None):
         return d
 
 
-def gtf_for_ggplot(annotation, start, end, arrow_bins):
-        arrow_space = int((end - start)/(arrow_bins/4))
+class RDataFile(object):
+        # Binary side file holding the numeric vectors of an R script, so
+        # that the script text does not grow with the size of the region
+
+        def __init__(self, path):
+                self.path = path
+                self.f = open(path, "wb")
+                self.offset = 0
+
+        def setup(self):
+                return """
+        read_vec = function(what, offset, n, size) {
+                con = file("%s", "rb")
+                on.exit(close(con))
+                seek(con, offset)
+                readBin(con, what, n=n, size=size, endian="%s")
+        }
+        """ %(self.path, sys.byteorder)
+
+        def vector(self, values):
+                values = list(values)
+                if all(isinstance(v, Integral) for v in values):
+                        a, what = array("i", values), "integer"
+                else:
+                        a, what = array("d", values), "double"
+                a.tofile(self.f)
+                s = 'read_vec("%s", %s, %s, %s)' %(what, self.offset, len(a), a.itemsize)
+                self.offset += len(a) * a.itemsize
+                return s
+
+        def close(self):
+                self.f.close()
+
+
+def gtf_for_ggplot(annotation, start, end, arrow_bins, data):
+        arrow_space = int((end - start)/(arrow_bins/4.0))
         s = """
 
         # data table with exons
@@ -355,16 +1811,16 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
 
                 s += """
                 ann_list[['exons']] = data.table(
-                        tx = rep(c(%(tx_exons)s), c(%(n_exons)s)),
-                        start = c(%(exon_start)s),
-                        end = c(%(exon_end)s),
+                        tx = rep(c(%(tx_exons)s), %(n_exons)s),
+                        start = %(exon_start)s,
+                        end = %(exon_end)s,
                         strand = c(%(strand)s)
                 )
                 """ %({
                 "tx_exons": ",".join(annotation["exons"].keys()),
-                "n_exons": ",".join(map(str, map(len, annotation["exons"].values()))),
-                "exon_start" : ",".join(map(str, (v[0] for vs in annotation["exons"].values() for v in vs))),
-                "exon_end" : ",".join(map(str, (v[1] for vs in annotation["exons"].values() for v in vs))),
+                "n_exons": data.vector(map(len, annotation["exons"].values())),
+                "exon_start" : data.vector(v[0] for vs in annotation["exons"].values() for v in vs),
+                "exon_end" : data.vector(v[1] for vs in annotation["exons"].values() for v in vs),
                 "strand" : ",".join(map(str, (v[2] for vs in annotation["exons"].values() for v in vs))),
                 })
 
@@ -372,9 +1828,9 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
 
                 s += """
                 ann_list[['introns']] = data.table(
-                        tx = rep(c(%(tx_introns)s), c(%(n_introns)s)),
-                        start = c(%(intron_start)s),
-                        end = c(%(intron_end)s),
+                        tx = rep(c(%(tx_introns)s), %(n_introns)s),
+                        start = %(intron_start)s,
+                        end = %(intron_end)s,
                         strand = c(%(strand)s)
                 )
                 # Create data table for strand arrows
@@ -404,9 +1860,9 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
                 }
                 """ %({
                         "tx_introns": ",".join(annotation["introns"].keys()),
-                        "n_introns": ",".join(map(str, map(len, annotation["introns"].values()))),
-                        "intron_start" : ",".join(map(str, (v[0] for vs in annotation["introns"].values() for v in vs))),
-                        "intron_end" : ",".join(map(str, (v[1] for vs in annotation["introns"].values() for v in vs))),
+                        "n_introns": data.vector(map(len, annotation["introns"].values())),
+                        "intron_start" : data.vector(v[0] for vs in annotation["introns"].values() for v in vs),
+                        "intron_end" : data.vector(v[1] for vs in annotation["introns"].values() for v in vs),
                         "strand" : ",".join(map(str, (v[2] for vs in annotation["introns"].values() for v in vs))),
                         "arrow_space" : arrow_space,
                 })
@@ -439,12 +1895,6 @@ def setup_R_script(h, w, b, label_dict):
         library(data.table)
         library(gtable)
 
-        scale_lwd = function(r) {
-                lmin = 0.1
-                lmax = 4
-                return( r*(lmax-lmin)+lmin )
-        }
-
         base_size = %(b)s
         height = ( %(h)s + base_size*0.352777778/67 ) * 1.02
         width = %(w)s
@@ -464,7 +1914,8 @@ def setup_R_script(h, w, b, label_dict):
         labels = list(%(labels)s)
 
         density_list = list()
-        junction_list = list()
+        arc_list = list()
+        label_list = list()
 
         """ %({
                 'h': h,
@@ -484,7 +1935,132 @@ def mean(lst):
         return sum(lst)/len(lst)
 
 
-def make_R_lists(id_list, d, overlay_dict, aggr, intersected_introns):
+def weighted_mean(y, w):
+        return sum(v*l for v, l in zip(y, w)) / float(sum(w))
+
+
+BIN_REDUCERS = {
+        "max": lambda y, w: max(y),
+        "min": lambda y, w: min(y),
+        "mean": weighted_mean,
+}
+
+
+def bin_density(x, y, w, nbins, reducer, keep=()):
+        # Merge the coverage runs falling in the same cell of a grid of about
+        # nbins bins. Runs longer than a cell stay whole and positions in keep
+        # get a single-base bin, so that junction anchor heights stay exact
+        f = BIN_REDUCERS[reducer]
+        x, y, w = split_runs(x, y, w, keep)
+        size = max(1, -(-sum(w) // nbins))
+        new_x, new_y, new_w = [], [], []
+        i = 0
+        while i < len(x):
+                j, width = i + 1, w[i]
+                if x[i] not in keep:
+                        # Stop at kept positions and at gaps left by --shrink
+                        while j < len(x) and x[j] not in keep and x[j] == x[i] + width and \
+                                        (x[i] - x[0]) // size == (x[j] + w[j] - 1 - x[0]) // size:
+                                width += w[j]
+                                j += 1
+                new_x.append(x[i])
+                new_y.append(f(y[i:j], w[i:j]))
+                new_w.append(width)
+                i = j
+        return new_x, new_y, new_w
+
+
+def plot_bins(args, c):
+        # Number of bins and reducer for the coverage of a region longer than
+        # the bin threshold, binned to the output resolution
+        _, start, end = parse_coordinates(c)
+        nbins = int(args.width * args.out_resolution)
+        if args.bin_threshold and end - start > max(args.bin_threshold, nbins):
+                return nbins, args.bin_reducer
+        return None
+
+
+def store_level(args, c):
+        # Coarsest level of the coverage stores with at least one bin per bin
+        # of the plot, and the reducer it is read with
+        bins = plot_bins(args, c)
+        if bins is None:
+                return None
+        _, start, end = parse_coordinates(c)
+        sizes = [size for size in STORE_LEVELS if (end - start) // size >= bins[0]]
+        return (sizes[-1], bins[1]) if sizes else None
+
+
+def R_round(v):
+        # Round half to even, as R does
+        r = math.floor(v + 0.5)
+        if r - v == 0.5 and r % 2:
+                r -= 1
+        return int(r)
+
+
+def covered_value(tracks, pos):
+        # Highest coverage at pos over the runs of the tracks, 0 if uncovered
+        values = []
+        for x, y, w in tracks:
+                i = bisect_right(x, pos) - 1
+                if i >= 0 and pos < x[i] + w[i]:
+                        values.append(y[i])
+        return max(values) if values else 0
+
+
+def scale_lwd(r, lmin=0.1, lmax=4):
+        return r*(lmax-lmin)+lmin
+
+
+def summarize_junctions(dons, accs, yd, ya, counts, aggr="", tracks=()):
+        # Merge the junctions of a track by position into the records of its
+        # arcs: donor, acceptor, anchor heights, count and label. With aggr
+        # the anchor heights are those of the (aggregated) coverage tracks
+        merged = OrderedDict()
+        for don, acc, h1, h2, n in sorted(zip(dons, accs, yd, ya, counts), key=lambda j: j[:2]):
+                if (don, acc) not in merged:
+                        merged[(don, acc)] = [h1, h2, []]
+                j = merged[(don, acc)]
+                j[0], j[1] = max(j[0], h1), max(j[1], h2)
+                j[2].append(n)
+        records = []
+        for (don, acc), (h1, h2, n) in merged.items():
+                count = R_round(sum(n) / float(len(n)))
+                if aggr:
+                        h1, h2 = covered_value(tracks, don - 1), covered_value(tracks, acc + 1)
+                        label = str(count)
+                else:
+                        label = ",".join(map(str, n))
+                records.append((don, acc, h1, h2, count, label))
+        return records
+
+
+def junction_arcs(records, maxheight):
+        # Lay out the arcs of a track, alternately above and below the
+        # coverage. Each arc is made of two x-splines, from the donor and from
+        # the acceptor to the label, given by four control points each
+        arcs = {"x": [], "y": [], "id": [], "lwd": []}
+        labels = {"x": [], "y": [], "label": []}
+        tot_counts = sum(r[4] for r in records)
+        for i, (don, acc, h1, h2, count, label) in enumerate(records):
+                xmid = (don + acc) / 2.
+                if i % 2 == 0:  # top
+                        ymid = max(h1, h2) * 1.2
+                else:  # bottom
+                        h1, h2, ymid = 0, 0, -0.3 * maxheight
+                for side, (pos, h) in enumerate(((don, h1), (acc, h2))):
+                        arcs["x"] += [pos, pos, xmid, xmid]
+                        arcs["y"] += [h, ymid, ymid, ymid]
+                        arcs["id"] += [2*i + side + 1] * 4
+                        arcs["lwd"].append(scale_lwd(float(count) / tot_counts))
+                labels["x"].append(xmid)
+                labels["y"].append(ymid)
+                labels["label"].append(label)
+        return arcs, labels
+
+
+def make_R_lists(id_list, d, overlay_dict, aggr, shrink, data, bins=None, fix_y_scale=False):
         s = ""
         aggr_f = {
                 "mean": mean,
@@ -492,68 +2068,191 @@ def make_R_lists(id_list, d, overlay_dict, aggr, intersected_introns):
         }
         id_list = id_list if not overlay_dict else overlay_dict.keys()
         # Iterate over ids to get bam signal and junctions
-        shrinked_introns = dict()
+        lists = OrderedDict()
         for k in id_list:
-                shrinked_introns_k, shrinked_intronsid = dict(), dict()
-                x, y, dons, accs, yd, ya, counts = [], [], [], [], [], [], []
+                x, y, w, dons, accs, yd, ya, counts = [], [], [], [], [], [], [], []
                 if not overlay_dict:
-                        x, y, dons, accs, yd, ya, counts = d[k]
-                        if intersected_introns:
-                                x, y = shrink_density(x, y, intersected_introns)
-                                shrinked_introns_k, dons, accs = shrink_junctions(dons, accs, intersected_introns)
-                                shrinked_introns.update(shrinked_introns_k)
+                        x, y, dons, accs, yd, ya, counts, w = d[k]
+                        if shrink:
+                                x, y, w = shrink_density(x, y, w, shrink)
+                                dons, accs = shrink_junctions(dons, accs, shrink)
+                        tracks = [(x, y, w)]
                 else:
+                        tracks = []
                         for id in overlay_dict[k]:
-                                xid, yid, donsid, accsid, ydid, yaid, countsid = d[id]
-                                if intersected_introns:
-                                        xid, yid = shrink_density(xid, yid, intersected_introns)
-                                        shrinked_intronsid, donsid, accsid = shrink_junctions(donsid, accsid, intersected_introns)
-                                        shrinked_introns.update(shrinked_intronsid)
-                                x += xid
-                                y += yid
+                                xid, yid, donsid, accsid, ydid, yaid, countsid, wid = d[id]
+                                if shrink:
+                                        xid, yid, wid = shrink_density(xid, yid, wid, shrink)
+                                        donsid, accsid = shrink_junctions(donsid, accsid, shrink)
+                                tracks.append((xid, yid, wid))
                                 dons += donsid
                                 accs += accsid
                                 yd += ydid
                                 ya += yaid
                                 counts += countsid
                         if aggr and "_j" not in aggr:
-                                x = d[overlay_dict[k][0]][0]
-                                y = list(map(aggr_f[aggr], zip(*(d[id][1] for id in overlay_dict[k]))))
-                                if intersected_introns:
-                                        x, y = shrink_density(x, y, intersected_introns)
+                                x, y, w = aggregate_runs([(d[id][0], d[id][1], d[id][7]) for id in overlay_dict[k]], aggr_f[aggr])
+                                if shrink:
+                                        x, y, w = shrink_density(x, y, w, shrink)
+                                tracks = [(x, y, w)]
                         #dons, accs, yd, ya, counts = [], [], [], [], []
+                x, y, w = [], [], []
+                keep = set(don-1 for don in dons) | set(acc+1 for acc in accs)
+                for i, (xt, yt, wt) in enumerate(tracks):
+                        if bins:
+                                xt, yt, wt = bin_density(xt, yt, wt, bins[0], bins[1], keep)
+                                tracks[i] = xt, yt, wt
+                        x += xt
+                        y += yt
+                        w += wt
+                lists[k] = x, y, w, summarize_junctions(dons, accs, yd, ya, counts, aggr, tracks)
+        # The arcs below the coverage depend on the height of the plots
+        maxheight = max([max(v[1]) for v in lists.values() if v[1]] or [0])
+        for k, (x, y, w, records) in lists.items():
+                if not fix_y_scale:
+                        maxheight = max(y) if y else 0
+                arcs, labels = junction_arcs(records, maxheight)
                 s += """
-                density_list[["%(id)s"]] = data.frame(x=c(%(x)s), y=c(%(y)s))
-                junction_list[["%(id)s"]] = data.frame(x=c(%(dons)s), xend=c(%(accs)s), y=c(%(yd)s), yend=c(%(ya)s), count=c(%(counts)s))
+                density_list[["%(id)s"]] = data.frame(x=%(x)s, y=%(y)s, w=%(w)s)
+                arc_list[["%(id)s"]] = list(x=%(arc_x)s, y=%(arc_y)s, id=%(arc_id)s, lwd=%(arc_lwd)s)
+                label_list[["%(id)s"]] = data.frame(x=%(label_x)s, y=%(label_y)s, label=c(%(labels)s))
                 """ %({
                         'id': k,
-                        'x' : ",".join(map(str, x)),
-                        'y' : ",".join(map(str, y)),
-                        'dons' : ",".join(map(str, dons)),
-                        'accs' : ",".join(map(str, accs)),
-                        'yd' : ",".join(map(str, yd)),
-                        'ya' : ",".join(map(str, ya)),
-                        'counts' : ",".join(map(str, counts))
+                        'x' : data.vector(x),
+                        'y' : data.vector(y),
+                        'w' : data.vector(w),
+                        'arc_x' : data.vector(arcs["x"]),
+                        'arc_y' : data.vector(arcs["y"]),
+                        'arc_id' : data.vector(arcs["id"]),
+                        'arc_lwd' : data.vector(arcs["lwd"]),
+                        'label_x' : data.vector(labels["x"]),
+                        'label_y' : data.vector(labels["y"]),
+                        'labels' : ",".join('"%s"' %(l) for l in labels["label"])
                 })
-        if intersected_introns:
+        if shrink:
+                # Axis breaks at shrunk positions, labelled with real ones
+                breaks, labels = shrink_breaks(shrink, [v[:3] for v in lists.values()])
                 s+= """
-                coord_dict = data.frame(shrinked=c(%(shrinked_introns_keys)s), real=c(%(shrinked_introns_values)s))
-                intersected_introns = data.frame(real_x=c(%(intersected_introns_x)s), real_xend=c(%(intersected_introns_xend)s))
+                breaks_x_shrinked = %(breaks)s
+                breaks_x = %(labels)s
                 """ %({
-                        'shrinked_introns_keys': ','.join(map(str, shrinked_introns.keys())),
-                        'shrinked_introns_values': ','.join(map(str, shrinked_introns.values())),
-                        'intersected_introns_x': ','.join([str(coord[0]) for coord in intersected_introns]),
-                        'intersected_introns_xend': ','.join([str(coord[1]) for coord in intersected_introns])
+                        'breaks': data.vector(breaks),
+                        'labels': data.vector(labels)
                 })
         return s
 
 
-def plot(R_script):
+R_WORKER_MARKER = "GGSASHIMI_JOB"
+
+R_WORKER_SCRIPT = """
+library(ggplot2)
+library(grid)
+library(gridExtra)
+library(data.table)
+library(gtable)
+
+# Source each script path received on stdin in its own environment
+jobs = file("stdin")
+open(jobs)
+while (length(job <- readLines(jobs, n=1)) > 0) {
+        status = tryCatch({
+                source(job, local=new.env())
+                "OK"
+        }, error = function(e) {
+                graphics.off()
+                paste("ERROR:", gsub("\\n", " ", conditionMessage(e)))
+        })
+        cat("\\n", "%s", "\\t", status, "\\t", job, "\\n", sep="")
+        flush(stdout())
+}
+""" % R_WORKER_MARKER
+
+
+class RWorker(object):
+        # Long-lived R process that loads the plotting libraries once and
+        # sources the scripts whose paths are sent through its stdin
+
+        def __init__(self):
+                self.p = None
+                fd, self.bootstrap = tempfile.mkstemp(suffix=".R")
+                with os.fdopen(fd, "w") as f:
+                        f.write(R_WORKER_SCRIPT)
+
+        def alive(self):
+                return self.p is not None and self.p.poll() is None
+
+        def submit(self, job):
+                # Return the job status, or None if the worker died or could
+                # not be started
+                try:
+                        if not self.alive():
+                                self.p = sp.Popen(["R", "--vanilla", "--slave", "-f", self.bootstrap], stdin=sp.PIPE, stdout=sp.PIPE)
+                        self.p.stdin.write((job + "\n").encode('utf-8'))
+                        self.p.stdin.flush()
+                        for line in iter(self.p.stdout.readline, b""):
+                                line = line.decode('utf-8').rstrip("\n")
+                                if line.startswith(R_WORKER_MARKER):
+                                        return line.split("\t")[1]
+                                if line:
+                                        print(line)
+                except (IOError, OSError):
+                        pass
+                if self.p is not None:
+                        self.p.kill()
+                        self.p.wait()
+                        self.p = None
+                return None
+
+        def render(self, R_script):
+                fd, job = tempfile.mkstemp(suffix=".R")
+                with os.fdopen(fd, "wb") as f:
+                        f.write(R_script.encode('utf-8'))
+                try:
+                        status = self.submit(job)
+                        if status is None:
+                                print("WARN: R worker exited unexpectedly. Restarting it.")
+                                status = self.submit(job)
+                finally:
+                        os.remove(job)
+                if status is None:
+                        status = "ERROR: R worker exited unexpectedly."
+                if status != "OK":
+                        print(status)
+                return status
+
+        def close(self):
+                if self.alive():
+                        self.p.stdin.close()
+                        self.p.wait()
+                if os.path.isfile(self.bootstrap):
+                        os.remove(self.bootstrap)
+
+
+def plot(R_script, worker=None):
+        # Run the R script and return its status, "OK" or an error message
+        if worker is not None:
+                return worker.render(R_script)
         p = sp.Popen("R --vanilla --slave", shell=True, stdin=sp.PIPE)
         p.communicate(input=R_script.encode('utf-8'))
         p.stdin.close()
-        p.wait()
-        return
+        if p.wait() != 0:
+                status = "ERROR: R exited with status %d." % p.returncode
+                print(status)
+                return status
+        return "OK"
+
+
+def save_plot(out, out_format, resolution):
+        # TIFF images will be lzw-compressed
+        compression = ', compression = "lzw"' if out_format == "tiff" else ""
+        return """
+                ggsave("%(out)s", plot = argrobs, device = "%(out_format)s", width = width, height = height, units = "in", dpi = %(resolution)s%(compression)s, limitsize = FALSE)
+                """ %({
+                        "out": out,
+                        "out_format": out_format,
+                        "resolution": resolution,
+                        "compression": compression
+                })
 
 
 def colorize(d, p, color_factor):
@@ -569,46 +2268,38 @@ def colorize(d, p, color_factor):
 
 
 
-if __name__ == "__main__":
-
-        strand_dict = {"plus": "+", "minus": "-"}
-
-        parser = define_options()
-        if len(sys.argv)==1:
-            parser.print_help()
-            sys.exit(1)
-        args = parser.parse_args()
-
-#       args.coordinates = "chrX:9609491-9612406"
-#       args.coordinates = "chrX:9609491-9610000"
-#       args.bam = "/nfs/no_backup/rg/epalumbo/projects/tg/work/8b/8b0ac8705f37fd772a06ab7db89f6b/2A_m4_n10_toGenome.bam"
-
-        if args.aggr and not args.overlay:
-                print("ERROR: Cannot apply aggregate function if overlay is not selected.")
-                exit(1)
-
-        palette = read_palette(args.palette)
+STRANDS = {"plus": "+", "minus": "-"}
+OUT_EXTENSIONS = ('.pdf', '.png', '.svg', '.tiff', '.tif', '.jpeg', '.jpg')
 
+def prepare_plot(args, samples, palette, annotation_cache=None, reads=None):
+        # Read the samples in args.coordinates, unless they are given in
+        # reads, and write the R script plotting them. Returns the output
+        # files, the time spent reading the bam files, the R script and the
+        # path of its data file
         bam_dict, overlay_dict, color_dict, id_list, label_dict = {"+":OrderedDict()}, OrderedDict(), OrderedDict(), [], OrderedDict()
         if args.strand != "NONE": bam_dict["-"] = OrderedDict()
         if args.junctions_bed != "": junctions_list = []
 
-        for id, bam, overlay_level, color_level, label_text in read_bam_input(args.bam, args.overlay, args.color_factor, args.labels):
-                if not os.path.isfile(bam):
-                        continue
-                a, junctions = read_bam(bam, args.coordinates, args.strand)
-                if a.keys() == ["+"] and all(map(lambda x: x==0, list(a.values()[0]))):
+        read_cache = open_read_cache(args)
+        level = store_level(args, args.coordinates)
+        tasks = ((bam, args.coordinates, args.strand, args.reader, args.min_coverage, read_cache, level, args.tile_size) for _, bam, _, _, _ in samples)
+
+        read_time = time.time()
+        if reads is None:
+                reads = parallel_map(read_sample, tasks, args.jobs)
+        for (id, bam, overlay_level, color_level, label_text), (junctions, prepared) in zip(samples, reads):
+                if prepared is None:
                         print("WARN: Sample {} has no reads in the specified area.".format(id))
                         continue
                 id_list.append(id)
                 label_dict[id] = label_text
-                for strand in a:
+                for strand in prepared:
                         # Store junction information
                         if args.junctions_bed:
                                 for k,v in zip(junctions[strand].keys(), junctions[strand].values()):
                                         if v > args.min_coverage:
                                                 junctions_list.append('\t'.join([args.coordinates.split(':')[0], str(k[0]), str(k[1]), id, str(v), strand]))
-                        bam_dict[strand][id] = prepare_for_R(a[strand], junctions[strand], args.coordinates, args.min_coverage)
+                        bam_dict[strand][id] = prepared[strand]
                 if color_level is None:
                         color_dict.setdefault(id, id)
                 if overlay_level is not None:
@@ -618,6 +2309,8 @@ if __name__ == "__main__":
                 if overlay_level is None:
                         color_dict.setdefault(id, color_level)
 
+        read_time = time.time() - read_time
+
         # No bam files
         if not bam_dict["+"]:
                 print("ERROR: No available bam files.")
@@ -632,65 +2325,96 @@ if __name__ == "__main__":
                 jbed.close()
 
         if args.gtf:
-                transcripts, exons = read_gtf(args.gtf, args.coordinates)
+                transcripts, exons = read_gtf(args.gtf, args.coordinates, annotation_cache)
+
+        out_formats = args.out_format.split(",")
+        # Output file names (allow tiff/tif and jpeg/jpg extensions)
+        out_suffixes = OrderedDict((out_format, out_format) for out_format in out_formats)
+        if args.out_prefix.endswith(OUT_EXTENSIONS):
+                out_split = os.path.splitext(args.out_prefix)
+                for out_format in out_formats:
+                        if (out_format == out_split[1][1:] or
+                        out_format == 'tiff' and out_split[1] in ('.tiff','.tif') or
+                        out_format == 'jpeg' and out_split[1] in ('.jpeg','.jpg')):
+                                args.out_prefix = out_split[0]
+                                out_suffixes[out_format] = out_split[1][1:]
 
-        if args.out_format not in ('pdf', 'png', 'svg', 'tiff', 'jpeg'):
-                print("ERROR: Provided output format '%s' is not available. Please select among 'pdf', 'png', 'svg', 'tiff' or 'jpeg'" % args.out_format)
-                exit(1)
+        debug = os.getenv('GGSASHIMI_DEBUG') is not None
+
+        # *** PLOT *** Define plot height
+        bam_height = args.height * len(id_list)
+        if args.overlay:
+                bam_height = args.height * len(overlay_dict)
+        if args.gtf:
+                bam_height += args.ann_height
+
+        # *** PLOT *** Start R script by loading libraries, initializing variables, etc...
+        # A single R session renders every strand and output format
+        R_script = setup_R_script(bam_height, args.width, args.base_size, label_dict)
+
+        R_script += colorize(color_dict, palette, args.color_factor)
+
+        # *** PLOT *** Numeric vectors are handed to R in a binary side file
+        if debug:
+                # Each region of a batch keeps its own R script and data
+                # next to its outputs
+                root, ext = os.path.splitext(args.out_prefix)
+                prefix = (root if ext in OUT_EXTENSIONS else args.out_prefix) + "." if args.regions else ""
+                data_path = os.path.abspath(prefix + "R_data")
+        else:
+                fd, data_path = tempfile.mkstemp(suffix=".bin")
+                os.close(fd)
+        data = RDataFile(data_path)
+        R_script += data.setup()
+
+        # *** PLOT *** Prepare annotation plot only for the first bam file.
+        # Unless it is shrunk, the annotation is the same for both strands
+        arrow_bins = 50
+        if args.gtf and not args.shrink:
+                annotation = make_introns(transcripts, exons)
+                x, w = bam_dict["+"][id_list[0]][0], bam_dict["+"][id_list[0]][7]
+                R_script += gtf_for_ggplot(annotation, x[0], x[-1] + w[-1] - 1, arrow_bins, data)
+                R_script += """
+                pdf(NULL)
+                gtfGrob = ggplotGrob(gtfp)
+                dev.log = dev.off()
+                """
+
+        # Bin the coverage of large regions to the output resolution
+        bins = plot_bins(args, args.coordinates)
 
         # Iterate for plus and minus strand
+        outputs = []
         for strand in bam_dict:
 
-                # Output file name (allow tiff/tif and jpeg/jpg extensions)
-                if args.out_prefix.endswith(('.pdf', '.png', '.svg', '.tiff', '.tif', '.jpeg', '.jpg')):
-                        out_split = os.path.splitext(args.out_prefix)
-                        if (args.out_format == out_split[1][1:] or
-                        args.out_format == 'tiff' and out_split[1] in ('.tiff','.tif') or
-                        args.out_format == 'jpeg' and out_split[1] in ('.jpeg','.jpg')):
-                                args.out_prefix = out_split[0]
-                                out_suffix = out_split[1][1:]
-                        else:
-                                out_suffix = args.out_format
-                else:
-                        out_suffix = args.out_format
                 out_prefix = args.out_prefix + "_" + strand
                 if args.strand == "NONE":
                         out_prefix = args.out_prefix
                 else:
-                        if args.out_strand != "both" and strand != strand_dict[args.out_strand]:
+                        if args.out_strand != "both" and strand != STRANDS[args.out_strand]:
                                 continue
+                outputs += ["%s.%s" % (out_prefix, out_suffixes[f]) for f in out_formats]
 
                 # Find set of junctions to perform shrink
-                intersected_introns = None
+                intersected_introns, shrink = None, None
                 if args.shrink:
                         introns = (v for vs in bam_dict[strand].values() for v in zip(vs[2], vs[3]))
                         intersected_introns = list(intersect_introns(introns))
+                        shrink = shrink_table(intersected_introns)
 
+                # Variables of each strand are local to its block
+                R_script += """
+                local({
+                """
 
-                # *** PLOT *** Define plot height
-                bam_height = args.height * len(id_list)
-                if args.overlay:
-                        bam_height = args.height * len(overlay_dict)
-                if args.gtf:
-                        bam_height += args.ann_height
-
-                # *** PLOT *** Start R script by loading libraries, initializing variables, etc...
-                R_script = setup_R_script(bam_height, args.width, args.base_size, label_dict)
-
-                R_script += colorize(color_dict, palette, args.color_factor)
-
-                # *** PLOT *** Prepare annotation plot only for the first bam file
-                arrow_bins = 50
-                if args.gtf:
+                if args.gtf and args.shrink:
                         # Make introns from annotation (they are shrunk if required)
-                        annotation = make_introns(transcripts, exons, intersected_introns)
-                        x = list(bam_dict[strand].values())[0][0]
-                        if args.shrink:
-                                x, _ = shrink_density(x, x, intersected_introns)
-                        R_script += gtf_for_ggplot(annotation, x[0], x[-1], arrow_bins)
-
-                R_script += make_R_lists(id_list, bam_dict[strand], overlay_dict, args.aggr, intersected_introns)
+                        annotation = make_introns(transcripts, exons, shrink)
+                        vs = list(bam_dict[strand].values())[0]
+                        x, _, w = shrink_density(vs[0], vs[0], vs[7], shrink)
+                        R_script += gtf_for_ggplot(annotation, x[0], x[-1] + w[-1] - 1, arrow_bins, data)
 
+                R_script += make_R_lists(id_list, bam_dict[strand], overlay_dict, args.aggr, shrink, data, bins, args.fix_y_scale)
                 R_script += """
 
                 pdf(NULL) # just to remove the blank pdf produced by ggplotGrob
@@ -706,79 +2430,20 @@ if __name__ == "__main__":
                         breaks_y = labeling::extended(0, maxheight, m = 4)
                 }
 
-                if(exists('coord_dict')){
-                        all_pos_shrinked = do.call(rbind, density_list)$x
-                        s2r = merge(intersected_introns, coord_dict, by.x = 'real_xend', by.y = 'real')
-                        s2r = merge(s2r, coord_dict, by.x = 'real_x', by.y = 'real', suffixes = c('_xend', '_x'))
-                        breaks_x_shrinked = labeling::extended(min(all_pos_shrinked), max(all_pos_shrinked), m = 5)
-                        breaks_x = c()
-                        out_range = c()
-                        for (b in breaks_x_shrinked){
-                                iintron = FALSE
-                                for (j in 1:nrow(s2r)){
-                                        l = s2r[j, ]
-                                        if(b >= l$shrinked_x && b <= l$shrinked_xend){
-                                                # Intersected intron
-                                                p = (b-l$shrinked_x)/(l$shrinked_xend - l$shrinked_x)
-                                                realb = round(l$real_x + p*(l$real_xend - l$real_x))
-                                                breaks_x = c(breaks_x, realb)
-                                                iintron = TRUE
-                                                break
-                                        }
-                                }
-                                if (!iintron){
-                                        # Exon, upstream/downstream intergenic region or intron (not intersected)
-                                        if(b <= min(s2r$shrinked_x)) {
-                                                l <- s2r[which.min(s2r$shrinked_x), ]
-                                                if(any(b == all_pos_shrinked)){
-                                                        # Boundary (subtract)
-                                                        s = l$shrinked_x - b
-                                                        realb = l$real_x - s
-                                                        breaks_x = c(breaks_x, realb)
-                                                } else {
-                                                        out_range <- c(out_range, which(breaks_x_shrinked == b))
-                                                }
-                                        } else if (b >= max(s2r$shrinked_xend)){
-                                                l <- s2r[which.max(s2r$shrinked_xend), ]
-                                                if(any(b == all_pos_shrinked)){
-                                                        # Boundary (sum)
-                                                        s = b - l$shrinked_xend
-                                                        realb = l$real_xend + s
-                                                        breaks_x = c(breaks_x, realb)
-                                                } else {
-                                                        out_range <- c(out_range, which(breaks_x_shrinked == b))
-                                                }
-                                        } else {
-                                                delta = b-s2r$shrinked_xend
-                                                delta[delta < 0] = Inf
-                                                l = s2r[which.min(delta), ]
-                                                # Internal (sum)
-                                                s = b - l$shrinked_xend
-                                                realb = l$real_xend + s
-                                                breaks_x = c(breaks_x, realb)
-                                        }
-                                }
-                        }
-                        if(length(out_range)) {
-                                breaks_x_shrinked = breaks_x_shrinked[-out_range]
-                        }
-                }
-
                 density_grobs = list();
 
                 for (bam_index in 1:length(density_list)) {
 
                         id = names(density_list)[bam_index]
-                        d = data.table(density_list[[id]])
-                        junctions = data.table(junction_list[[id]])
+                        d = density_list[[id]]
 
-                        # Density plot
-                        gp = ggplot(d) + geom_bar(aes(x, y), width=1, position='identity', stat='identity', fill=color_list[[id]], alpha=%(alpha)s)
+                        # Density plot, one rectangle per coverage run
+                        gp = ggplot(d) + geom_rect(aes(xmin=x-0.5, xmax=x+w-0.5, ymin=0, ymax=y), fill=color_list[[id]], alpha=%(alpha)s)
                         gp = gp + labs(y=labels[[id]])
                         #
                         # gp = gp + theme(axis.text.x = element_blank())
                         #
-                        if(exists('coord_dict')) {
+                        if(exists('breaks_x')) {
                                 gp = gp + scale_x_continuous(expand=c(0, 0.25), breaks = breaks_x_shrinked, labels = breaks_x, position="top")
                         } else {
                                 gp = gp + scale_x_continuous(expand=c(0, 0.25))
@@ -792,76 +2457,23 @@ if __name__ == "__main__":
                                 gp = gp + scale_y_continuous(breaks = breaks_y, limits = c(NA, maxheight*1.25))
                         }
 
-                        # Aggregate junction counts
-                        row_i = c()
-                        if (nrow(junctions) >0 ) {
-
-                                junctions$jlabel = as.character(junctions$count)
-                                junctions = setNames(junctions[,.(max(y), max(yend),round(mean(count)),paste(jlabel,collapse=",")), keyby=.(x,xend)], names(junctions))
-                                if ("%(args.aggr)s" != "") {
-                                        junctions = setNames(junctions[,.(max(y), max(yend),round(%(args.aggr)s(count)),round(%(args.aggr)s(count))), keyby=.(x,xend)], names(junctions))
-                                }
-                                # The number of rows (unique junctions per bam) has to be calculated after aggregation
-                                row_i = 1:nrow(junctions)
-                        }
-
-
-                        for (i in row_i) {
-
-                                j_tot_counts = sum(junctions[['count']])
-
-                                j = as.numeric(junctions[i,1:5])
-
-                                if ("%(args.aggr)s" != "") {
-                                        j[3] = ifelse(length(d[x==j[1]-1,y])==0, 0, max(as.numeric(d[x==j[1]-1,y])))
-                                        j[4] = ifelse(length(d[x==j[2]+1,y])==0, 0, max(as.numeric(d[x==j[2]+1,y])))
-                                }
-
-                                # Find intron midpoint
-                                xmid = round(mean(j[1:2]), 1)
-                                ymid = max(j[3:4]) * 1.2
-
-                                # Thickness of the arch
-                                lwd = scale_lwd(j[5]/j_tot_counts)
-
-                                curve_par = gpar(lwd=lwd, col=color_list[[id]])
-
-                                # Arc grobs
-
-                                # Choose position of the arch (top or bottom)
-                                nss = i
-                                if (nss%%%%2 == 0) {  #bottom
-                                        ymid = -0.3 * maxheight
-                                        # Draw the arcs
-                                        # Left
-                                        curve = xsplineGrob(x=c(0, 0, 1, 1), y=c(1, 0, 0, 0), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, j[1], xmid, 0, ymid)
-                                        # Right
-                                        curve = xsplineGrob(x=c(1, 1, 0, 0), y=c(1, 0, 0, 0), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, xmid, j[2], 0, ymid)
-                                }
-
-                                if (nss%%%%2 != 0) {  #top
-                                        # Draw the arcs
-                                        # Left
-                                        curve = xsplineGrob(x=c(0, 0, 1, 1), y=c(0, 1, 1, 1), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, j[1], xmid, j[3], ymid)
-                                        # Right
-                                        curve = xsplineGrob(x=c(1, 1, 0, 0), y=c(0, 1, 1, 1), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, xmid, j[2], j[4], ymid)
+                        # Junction arcs, drawn as a single grob of x-splines
+                        arcs = arc_list[[id]]
+                        if (length(arcs$x) > 0) {
+                                xr = range(arcs$x)
+                                yr = range(arcs$y)
+                                if (diff(yr) == 0) {
+                                        yr = yr + c(-1, 1)
                                 }
+                                curves = xsplineGrob(x=(arcs$x-xr[1])/diff(xr), y=(arcs$y-yr[1])/diff(yr), id=arcs$id,
+                                        shape=1, gp=gpar(lwd=arcs$lwd, col=color_list[[id]]))
+                                gp = gp + annotation_custom(grob = curves, xr[1], xr[2], yr[1], yr[2])
 
                                 # Add junction labels
-                                gp = gp + annotate("label", x = xmid, y = ymid, label = as.character(junctions[i,6]),
+                                gp = gp + geom_label(data=label_list[[id]], aes(x=x, y=y, label=label), inherit.aes=FALSE,
                                         vjust=0.5, hjust=0.5, label.padding=unit(0.01, "lines"),
                                         label.size=NA, size=(base_size*0.352777778)*0.6
                                 )
-
-
-                #               gp = gp + annotation_custom(grob = rectGrob(x=0, y=0, gp=gpar(col="red"), just=c("left","bottom")), xmid, j[2], j[4], ymid)
-                #               gp = gp + annotation_custom(grob = rectGrob(x=0, y=0, gp=gpar(col="green"), just=c("left","bottom")), j[1], xmid, j[3], ymid)
-
-
                         }
 
                         gpGrob = ggplotGrob(gp);
@@ -896,7 +2508,9 @@ if __name__ == "__main__":
 
                 # Annotation grob
                 if (%(args.gtf)s == 1) {
-                        gtfGrob = ggplotGrob(gtfp);
+                        if (!exists('gtfGrob')) {
+                                gtfGrob = ggplotGrob(gtfp);
+                        }
                         maxWidth = grid::unit.pmax(maxWidth, gtfGrob$widths[2+vs] + gtfGrob$widths[3+vs]); # fix problems ggplot2 vs
                         density_grobs[['gtf']] = gtfGrob;
                         #density_grobs[['xaxis']] = xaxisGrob
@@ -923,30 +2537,335 @@ if __name__ == "__main__":
                         heights = heights,
                 );
 
-                # Save plot to file in the requested format
-                if ("%(out_format)s" == "tiff"){
-                        # TIFF images will be lzw-compressed
-                        ggsave("%(out)s", plot = argrobs, device = "tiff", width = width, height = height, units = "in", dpi = %(out_resolution)s, compression = "lzw", limitsize = FALSE)
-                } else {
-                        ggsave("%(out)s", plot = argrobs, device = "%(out_format)s", width = width, height = height, units = "in", dpi = %(out_resolution)s, limitsize = FALSE)
-                }
-
+                # Save plot to file in the requested formats
+                %(save)s
                 dev.log = dev.off()
+                })
 
                 """ %({
-                        "out": "%s.%s" % (out_prefix, out_suffix),
-                        "out_format": args.out_format,
-                        "out_resolution": args.out_resolution,
+                        "save": "".join(save_plot("%s.%s" % (out_prefix, out_suffixes[f]), f, args.out_resolution) for f in out_formats),
                         "args.gtf": float(bool(args.gtf)),
-                        "args.aggr": args.aggr.rstrip("_j"),
                         "signal_height": args.height,
                         "ann_height": args.ann_height,
                         "alpha": args.alpha,
                         "fix_y_scale": ("TRUE" if args.fix_y_scale else "FALSE")
                         })
-                if os.getenv('GGSASHIMI_DEBUG') is not None:
-                        with open("R_script", 'w') as r:
-                                r.write(R_script)
+
+        data.close()
+
+        return outputs, read_time, R_script, data_path
+
+
+def render_plot(R_script, data_path, worker=None):
+        # Run the R script of prepare_plot. Returns the status of R and the
+        # time spent in it
+        plot_time = time.time()
+        status = "OK"
+        if os.getenv('GGSASHIMI_DEBUG') is not None:
+                # Named after the R data file of prepare_plot
+                with open(data_path[:-len("R_data")] + "R_script", 'w') as r:
+                        r.write(R_script)
+        else:
+                status = plot(R_script, worker)
+                os.remove(data_path)
+        return status, time.time() - plot_time
+
+
+def plot_region(args, samples, palette, annotation_cache=None, worker=None, reads=None):
+        outputs, read_time, R_script, data_path = prepare_plot(args, samples, palette, annotation_cache, reads)
+        status, plot_time = render_plot(R_script, data_path, worker)
+        return status, outputs, read_time, plot_time
+
+
+def read_regions(f):
+        # Name and coordinates of the regions in a BED file
+        regions = []
+        with open(f) as openf:
+                for line in openf:
+                        if not line.strip() or line.startswith(("#", "track", "browser")):
+                                continue
+                        fields = line.rstrip("\n").split("\t")
+                        chr, start, end = fields[0], int(fields[1]), int(fields[2])
+                        name = fields[3] if len(fields) > 3 and fields[3] else "%s_%s_%s" %(chr, start, end)
+                        # BED starts are 0-based
+                        regions.append((re.sub(r"[^\w.+-]", "_", name), "%s:%s-%s" %(chr, start + 1, end)))
+        return regions
+
+
+def region_prefix(out_prefix, name):
+        # Add the region name to the prefix, before the file extension if any
+        root, ext = os.path.splitext(out_prefix)
+        if ext in OUT_EXTENSIONS:
+                return "%s_%s%s" %(root, name, ext)
+        return "%s_%s" %(out_prefix, name)
+
+
+PROCESS_WORKERS = {}
+
+def process_worker():
+        # R worker of the current process, started on first use. Pool
+        # processes exit without running atexit handlers, but run the
+        # finalizers of multiprocessing, which close the worker
+        if os.getpid() not in PROCESS_WORKERS:
+                worker = RWorker()
+                Finalize(worker, worker.close, exitpriority=0)
+                PROCESS_WORKERS[os.getpid()] = worker
+        return PROCESS_WORKERS[os.getpid()]
+
+
+def prepare_batch_region(args, samples, palette, annotation_cache, name, coordinates, reads=None):
+        region_args = Namespace(**vars(args))
+        region_args.coordinates = coordinates
+        region_args.out_prefix = region_prefix(args.out_prefix, name)
+        if args.junctions_bed:
+                region_args.junctions_bed = region_prefix(re.sub(r"\.bed$", "", args.junctions_bed), name)
+        t = time.time()
+        errors = [sample for sample in reads or [] if isinstance(sample, IOError)]
+        if errors:
+                # A bam file could not be read in the single pass over the regions
+                print("ERROR: Region '%s' (%s) could not be read: %s" %(name, coordinates, errors[0]))
+                return name, coordinates, "ERROR", [], 0, None, None, t
+        try:
+                outputs, read_time, R_script, data_path = prepare_plot(region_args, samples, palette, annotation_cache, reads)
+        except SystemExit:
+                # The error has already been printed, carry on with the batch
+                return name, coordinates, "ERROR", [], 0, None, None, t
+        except Exception as e:
+                print("ERROR: Region '%s' (%s) could not be plotted: %s" %(name, coordinates, e))
+                return name, coordinates, "ERROR", [], 0, None, None, t
+        return name, coordinates, "OK", outputs, read_time, R_script, data_path, t
+
+
+def render_batch_region(name, coordinates, status, outputs, read_time, R_script, data_path, t, worker=None):
+        plot_time = 0
+        if status == "OK":
+                status, plot_time = render_plot(R_script, data_path, worker)
+                if status != "OK":
+                        status, outputs = "ERROR", []
+        return name, coordinates, status, outputs, read_time, plot_time, time.time() - t
+
+
+def plot_batch_region(*task):
+        worker = process_worker() if task[0].r_worker else None
+        return render_batch_region(*prepare_batch_region(*task), worker=worker)
+
+
+def pipeline(produce, consume, tasks, size=2):
+        # Yield consume(*produce(*task)) for each task in order. A thread runs
+        # produce ahead of consume, through a queue of at most size results,
+        # so that producing the next task overlaps consuming the current one
+        queue = Queue(maxsize=size)
+
+        def producer():
+                try:
+                        for task in tasks:
+                                queue.put((True, produce(*task)))
+                        queue.put(None)
+                except BaseException as e:
+                        queue.put((False, e))
+
+        thread = threading.Thread(target=producer)
+        thread.daemon = True
+        thread.start()
+        for item in iter(queue.get, None):
+                ok, result = item
+                if not ok:
+                        raise result
+                yield consume(*result)
+        thread.join()
+
+
+def plot_regions(args, samples, palette, annotation_cache=None, worker=None):
+        # Plot every region of args.regions and write a summary of the
+        # outputs and timings
+        regions = read_regions(args.regions)
+        batch_args = args
+        if args.region_jobs > 1:
+                # Processes of a pool cannot start pools of their own
+                batch_args = Namespace(**vars(args))
+                batch_args.jobs = 1
+        reads = [None] * len(regions)
+        single_pass_time = None
+        if args.single_pass:
+                # Read each bam file once for all the regions, then hand each
+                # region its share
+                single_pass_time = time.time()
+                coordinates = [c for _, c in regions]
+                read_cache = open_read_cache(args)
+                levels = [store_level(args, c) for c in coordinates]
+                sample_tasks = ((bam, coordinates, args.strand, args.reader, args.min_coverage, read_cache, levels, args.tile_size) for _, bam, _, _, _ in samples)
+                reads = list(zip(*parallel_map(read_sample_regions, sample_tasks, args.jobs))) or reads
+                single_pass_time = time.time() - single_pass_time
+        tasks = ((batch_args, samples, palette, annotation_cache, name, c, r) for (name, c), r in zip(regions, reads))
+        root, ext = os.path.splitext(args.out_prefix)
+        summary = (root if ext in OUT_EXTENSIONS else args.out_prefix) + "_summary.tsv"
+        with open(summary, "w") as openf:
+                openf.write("\t".join(("name", "region", "status", "outputs", "read_seconds", "plot_seconds", "total_seconds")) + "\n")
+                if single_pass_time is not None:
+                        openf.write("single_pass\t*\tOK\t\t%.3f\t%.3f\t%.3f\n" %(single_pass_time, 0, single_pass_time))
+                if args.region_jobs > 1:
+                        results = parallel_map(plot_batch_region, tasks, args.region_jobs)
+                else:
+                        # Read the bam files of the next regions while R draws the current one
+                        render = lambda *job: render_batch_region(*job, worker=worker)
+                        results = pipeline(prepare_batch_region, render, tasks, args.queue_size)
+                for name, coordinates, status, outputs, read_time, plot_time, total_time in results:
+                        openf.write("%s\t%s\t%s\t%s\t%.3f\t%.3f\t%.3f\n" %(name, coordinates, status, ",".join(outputs), read_time, plot_time, total_time))
+                        openf.flush()
+
+
+def index_stores(args):
+        # Build the store of each bam file and a copy of the list of bam
+        # files pointing at them. Stores that are complete are kept, and
+        # interrupted ones are resumed
+        if not os.path.isdir(args.out_dir):
+                os.makedirs(args.out_dir)
+        rows = []
+        for id, bam, _, _, _ in read_bam_input(args.bam, None, None, 1):
+                if not os.path.isfile(bam):
+                        print("WARN: Bam file {} was not found.".format(bam))
+                        continue
+                rows.append((id, bam, re.sub(r"[^\w.+-]", "_", id) + STORE_SUFFIX))
+        tasks = ((bam, os.path.join(args.out_dir, store), args.strand, args.reader, args.chunk_size) for _, bam, store in rows)
+        for store, status, t in parallel_map(build_store, tasks, args.jobs):
+                sys.stderr.write("%s %s in %.3f s\n" %(store, "built" if t else "up to date", t))
+
+        stores = dict((bam, store) for _, bam, store in rows)
+        with open(os.path.join(args.out_dir, "stores.tsv"), "w") as out:
+                if args.bam.endswith(".bam"):
+                        out.write("%s\t%s\n" %(rows[0][0], rows[0][2]) if rows else "")
+                        return
+                with codecs.open(args.bam, encoding='utf-8') as openf:
+                        for line in openf:
+                                line_sp = line.rstrip("\n").split("\t")
+                                bam = get_bam_path(args.bam, line_sp[1])
+                                if bam in stores:
+                                        line_sp[1] = stores[bam]
+                                        out.write("\t".join(line_sp) + "\n")
+
+
+if __name__ == "__main__":
+
+        if len(sys.argv) > 1 and sys.argv[1] == "index":
+                args = define_index_options().parse_args(sys.argv[2:])
+                if args.reader not in BAM_READERS:
+                        print("ERROR: Provided reader '%s' is not available. Please select among 'samtools' or 'pysam'" % args.reader)
+                        exit(1)
+                if args.reader == "pysam" and pysam is None:
+                        print("ERROR: The pysam reader requires the pysam python module to be installed.")
+                        exit(1)
+                if args.jobs < 1:
+                        print("ERROR: The number of jobs must be at least 1.")
+                        exit(1)
+                if args.chunk_size < 1 or args.chunk_size % STORE_LEVELS[-1]:
+                        print("ERROR: The chunk size must be a multiple of %d." % STORE_LEVELS[-1])
+                        exit(1)
+                index_stores(args)
+                exit()
+
+        parser = define_options()
+        if len(sys.argv)==1:
+            parser.print_help()
+            sys.exit(1)
+        args = parser.parse_args()
+
+#       args.coordinates = "chrX:9609491-9612406"
+#       args.coordinates = "chrX:9609491-9610000"
+#       args.bam = "/nfs/no_backup/rg/epalumbo/projects/tg/work/8b/8b0ac8705f37fd772a06ab7db89f6b/2A_m4_n10_toGenome.bam"
+
+        if args.aggr and not args.overlay:
+                print("ERROR: Cannot apply aggregate function if overlay is not selected.")
+                exit(1)
+
+        if args.reader not in BAM_READERS:
+                print("ERROR: Provided reader '%s' is not available. Please select among 'samtools' or 'pysam'" % args.reader)
+                exit(1)
+
+        if args.reader == "pysam" and pysam is None:
+                print("ERROR: The pysam reader requires the pysam python module to be installed.")
+                exit(1)
+
+        if args.bin_reducer not in BIN_REDUCERS:
+                print("ERROR: Provided bin reducer '%s' is not available. Please select among 'max', 'min' or 'mean'" % args.bin_reducer)
+                exit(1)
+
+        if args.jobs < 1 or args.region_jobs < 1 or args.queue_size < 1:
+                print("ERROR: The number of jobs must be at least 1.")
+                exit(1)
+
+        if args.tile_size < 0:
+                print("ERROR: The tile size cannot be negative.")
+                exit(1)
+
+        if args.read_cache:
+                if not args.cache_dir:
+                        print("ERROR: The read cache (--read-cache) needs a cache directory (--cache-dir).")
+                        exit(1)
+                if not os.path.isdir(os.path.join(args.cache_dir, "reads")):
+                        os.makedirs(os.path.join(args.cache_dir, "reads"))
+
+        # Look up the coordinates of a gene or transcript in the annotation cache
+        annotation_cache = None
+        temp_cache_dir = None
+        if args.coordinates and not is_region(args.coordinates):
+                if not args.gtf:
+                        print("ERROR: A gtf file (-g) is needed to find the coordinates of '%s'." % args.coordinates)
+                        exit(1)
+                annotation_cache = load_annotation_cache(args.gtf, args.cache_dir)
+                if annotation_cache is not None:
+                        region = annotation_cache.lookup(args.coordinates)
                 else:
-                        plot(R_script)
-        exit()
+                        region = lookup_gtf(args.gtf, args.coordinates)
+                if region is None:
+                        print("ERROR: '%s' was not found in the gtf file." % args.coordinates)
+                        exit(1)
+                chr, start, end = region
+                args.coordinates = "%s:%s-%s" %(chr, max(1, start + 1 - args.pad), end + args.pad)
+
+        palette = read_palette(args.palette)
+
+        for out_format in args.out_format.split(","):
+                if out_format not in ('pdf', 'png', 'svg', 'tiff', 'jpeg'):
+                        print("ERROR: Provided output format '%s' is not available. Please select among 'pdf', 'png', 'svg', 'tiff' or 'jpeg'" % out_format)
+                        exit(1)
+
+        samples = [sample for sample in read_bam_input(args.bam, args.overlay, args.color_factor, args.labels) if os.path.isfile(sample[1]) or is_store(sample[1])]
+
+        for _, bam, _, _, _ in samples:
+                if is_store(bam):
+                        manifest = store_manifest(bam)
+                        if manifest is None or not manifest.get("complete"):
+                                print("ERROR: The coverage store '%s' is incomplete. Please run the index command again." % bam)
+                                exit(1)
+                        if manifest["strand"] != args.strand:
+                                print("ERROR: The coverage store '%s' was built with --strand %s." %(bam, manifest["strand"]))
+                                exit(1)
+
+        if args.gtf:
+                if args.index_gtf:
+                        args.gtf = index_gtf(args.gtf)
+                # The annotation is parsed once for all the regions of a batch,
+                # into a temporary cache when there is no cache directory
+                if (args.gtf_cache or args.regions) and annotation_cache is None:
+                        cache_dir = args.cache_dir
+                        if cache_dir is None and not args.gtf_cache:
+                                cache_dir = temp_cache_dir = tempfile.mkdtemp()
+                        annotation_cache = load_annotation_cache(args.gtf, cache_dir)
+
+        worker = process_worker() if args.r_worker else None
+
+        status = "OK"
+        if args.regions:
+                plot_regions(args, samples, palette, annotation_cache, worker)
+        else:
+                try:
+                        status = plot_region(args, samples, palette, annotation_cache, worker)[0]
+                except IOError as e:
+                        print("ERROR: %s" % e)
+                        exit(1)
+
+        if worker is not None:
+                worker.close()
+        if temp_cache_dir is not None:
+                shutil.rmtree(temp_cache_dir)
+        exit(0 if status == "OK" else 1)
@@ -1,10 +1,34 @@
 #!/usr/bin/env python
 import re
-import importlib 
+import os
+import importlib
+import subprocess
+import pytest
 from collections import OrderedDict
 
 sp = importlib.import_module('sashimi-plot')
 
+# Alignments of chr1 as (1-based position, flag, CIGAR), sorted by position
+READS = [(1000, 0, [("M", 50)]), (1040, 16, [("M", 20), ("N", 300), ("M", 30)]),
+         (1200, 0, [("M", 10), ("N", 100), ("M", 40)]), (1290, 0, [("M", 20)]),
+         (1300, 16, [("S", 5), ("M", 25), ("N", 500), ("M", 25)]), (4090, 0, [("M", 20)])]
+
+def fake_reader(reads, fetched=None):
+    # Reader of BAM_READERS reporting once each of the reads overlapping the
+    # regions, and recording the regions in fetched
+    def reader(f, regions):
+        if fetched is not None:
+            fetched.append(regions)
+        seen = set()
+        for c in regions:
+            _, start, end = sp.parse_coordinates(c)
+            for i, (pos, flag, CIGAR) in enumerate(reads):
+                read_end = pos + sum(l for op, l in CIGAR if op in "MDN") - 1
+                if i not in seen and pos <= end and read_end > start:
+                    seen.add(i)
+                    yield "chr1", flag, pos, iter(CIGAR)
+    return reader
+
 def test_parse_coordinates():
     for s in ['chr1:1000-2000', 'chr1:1,000-2,000']:
         assert sp.parse_coordinates(s) == ("chr1", 999, 2000)
@@ -50,6 +74,27 @@ def test_count_operator():
     assert all(p)
     assert j[(pos-2852,pos)] == 1
 
+def test_count_operator_diff():
+    _, start, end = sp.parse_coordinates('chr10:27035000-27050000')
+
+    c = [0] * (end - start)
+    d = [0] * (end - start + 1)
+    j, jd = OrderedDict(), OrderedDict()
+
+    # blocks overlapping the window boundaries are clipped
+    for pos, op, l in [(start - 10, 'M', 30), (start + 100, 'M', 50), (start + 120, 'M', 10),
+                       (start + 150, 'N', 200), (end - 20, 'M', 40)]:
+        new_pos = sp.count_operator(op, l, pos, start, end, c, j)
+        assert sp.count_operator(op, l, pos, start, end, d, jd, diff=True) == new_pos
+
+    assert j == jd
+
+    x, y, w = sp.coverage_runs(d, start)
+    assert sum(w) == len(c)
+    assert [v for v, l in zip(y, w) for _ in range(l)] == c
+    assert all(a != b for a, b in zip(y, y[1:]))
+    assert sp.run_value((x, y, w), start + 105) == c[105]
+
 def test_flip_read():
     assert sp.flip_read('NONE', 4) == 0
     assert sp.flip_read('SENSE', 4) == 0
@@ -102,3 +147,381 @@ def test_intersect_introns():
     i = list(sp.intersect_introns(data))
     assert len(i) == 2
     assert i == [(27040713, 27044584), (27044671, 27047991)]
+
+def test_R_data_file(tmpdir):
+    data = sp.RDataFile(str(tmpdir.join("R_data")))
+    assert data.vector([1, 2, 3]) == 'read_vec("integer", 0, 3, 4)'
+    assert data.vector([0.5, 2]) == 'read_vec("double", 12, 2, 8)'
+    assert data.vector([]) == 'read_vec("integer", 28, 0, 4)'
+    data.close()
+    assert tmpdir.join("R_data").size() == 28
+
+def test_bin_density():
+    x = list(range(100, 120))
+    y = list(range(20))
+    w = [1] * 20
+
+    bx, by, bw = sp.bin_density(x, y, w, 4, "max")
+    assert bx == [100, 105, 110, 115]
+    assert by == [4, 9, 14, 19]
+    assert bw == [5, 5, 5, 5]
+
+    # kept positions get their own exact bin
+    bx, by, bw = sp.bin_density(x, y, w, 4, "mean", keep={107})
+    assert bx == [100, 105, 107, 108, 110, 115]
+    assert by[2] == 7
+    assert bw == [5, 2, 1, 2, 5, 5]
+    assert sum(bw) == len(x)
+
+    # long runs are not merged, and the mean is weighted by run length
+    bx, by, bw = sp.bin_density([100, 101, 102, 150], [2, 4, 8, 0], [1, 1, 48, 50], 10, "mean")
+    assert bx == [100, 102, 150]
+    assert by == [3, 8, 0]
+    assert bw == [2, 48, 50]
+
+def test_aggregate_runs():
+    tracks = [([100, 110], [1, 3], [10, 10]), ([100, 105, 115], [3, 1, 3], [5, 10, 5])]
+    assert sp.aggregate_runs(tracks, max) == ([100, 105, 110], [3, 1, 3], [5, 5, 10])
+    assert sp.split_runs([100], [1], [10], {100, 104}) == ([100, 101, 104, 105], [1, 1, 1, 1], [1, 3, 1, 5])
+
+def test_read_gtf_indexed(tmpdir):
+    pytest.importorskip("pysam")
+    gtf = tmpdir.join("annotation.gtf")
+    gtf.write(open("examples/annotation.gtf").read())
+
+    indexed = sp.index_gtf(str(gtf))
+    assert indexed == str(gtf) + ".bgz"
+    assert sp.is_indexed(indexed)
+
+    for c in ['chr10:27040584-27048100', 'chr10:27035000-27050000', 'chr1:1000-2000']:
+        assert sp.read_gtf(indexed, c) == sp.read_gtf(str(gtf), c)
+
+def test_annotation_cache(tmpdir):
+    gtf = tmpdir.join("annotation.gtf")
+    gtf.write(open("examples/annotation.gtf").read())
+
+    cold = sp.load_annotation_cache(str(gtf))
+    assert tmpdir.join("annotation.gtf.cache").check()
+    warm = sp.load_annotation_cache(str(gtf))
+    assert warm.valid()
+
+    for c in ['chr10:27040584-27048100', 'chr10:27035000-27050000', 'chr1:1000-2000']:
+        expected = sp.read_gtf(str(gtf), c)
+        assert sp.read_gtf(str(gtf), c, cold) == expected
+        assert sp.read_gtf(str(gtf), c, warm) == expected
+
+    # the cache is invalidated when the gtf changes
+    gtf.write("\n", mode="a")
+    assert not sp.AnnotationCache(str(tmpdir.join("annotation.gtf.cache")), str(gtf)).valid()
+
+def test_annotation_cache_lookup(tmpdir):
+    gtf = tmpdir.join("annotation.gtf")
+    gtf.write(open("examples/annotation.gtf").read())
+    cache = sp.load_annotation_cache(str(gtf), str(tmpdir.join("cache")))
+
+    assert not sp.is_region('ABI1')
+    assert sp.is_region('chr10:27,035,000-27,050,000')
+    assert cache.lookup('ABI1') == ('chr10', 27035521, 27150016)
+    assert cache.lookup('ENST00000376170.4') == ('chr10', 27035521, 27149821)
+    assert cache.lookup('ABI2') is None
+
+    # without a writable cache directory the gtf file is parsed directly
+    tmpdir.join("file").write("")
+    assert sp.load_annotation_cache(str(gtf), str(tmpdir.join("file"))) is None
+    for name in ['ABI1', 'ENST00000376170.4', 'ABI2']:
+        assert sp.lookup_gtf(str(gtf), name) == cache.lookup(name)
+
+def test_shrink():
+    table = sp.shrink_table([(110, 150), (160, 200)])
+    assert table["junction_shifts"] == [0, 27, 54]
+
+    x = list(range(100, 210))
+    new_x, new_y, new_w = sp.shrink_density(x, x, [1] * len(x), table)
+    assert new_y == list(range(100, 111)) + list(range(150, 161)) + list(range(200, 210))
+    assert new_x[:12] == list(range(100, 111)) + [123]
+    assert new_x[-1] == 155
+
+    # runs crossing an intron are cut at its ends
+    assert sp.shrink_density([100], [5], [110], table) == ([100, 123, 146], [5, 5, 5], [11, 11, 10])
+
+    dons, accs = sp.shrink_junctions([110, 110, 160], [150, 200, 200], table)
+    assert dons == [110, 110, 133]
+    assert accs == [123, 146, 146]
+
+    assert sp.extended_breaks(0, 100, 5) == [0, 25, 50, 75, 100]
+    assert sp.extended_breaks(27040584, 27048100, 5) == [27040000, 27042000, 27044000, 27046000, 27048000]
+
+    # breaks inside shrunk introns are interpolated, the others shifted back
+    breaks, labels = sp.shrink_breaks(table, [(new_x, new_y, [1] * len(new_x))])
+    assert breaks == [100, 110, 120, 130, 140, 150]
+    assert labels == [100, 110, 141, 157, 182, 204]
+
+def test_make_introns():
+    transcripts = OrderedDict([('"t1"', (100, 400, '"+"')), ('"t2"', (100, 400, '"+"'))])
+    exons = OrderedDict([
+        ('"t1"', [(100, 120, '"+"'), (200, 220, '"+"'), (380, 400, '"+"')]),
+        # the second exon lies inside the second shrunk intron
+        ('"t2"', [(100, 120, '"+"'), (300, 310, '"+"'), (380, 400, '"+"')]),
+    ])
+
+    d = sp.make_introns(transcripts, exons)
+    assert d['exons'] == exons
+    assert d['introns']['"t1"'] == [(120, 200, '"+"'), (220, 380, '"+"')]
+
+    d = sp.make_introns(transcripts, exons, sp.shrink_table([(120, 200), (220, 380)]))
+    assert d['transcripts'] == OrderedDict([('"t1"', (100, 215, '"+"')), ('"t2"', (100, 215, '"+"'))])
+    assert d['exons']['"t1"'] == [(100, 120, '"+"'), (141, 161, '"+"'), (195, 215, '"+"')]
+    assert d['exons']['"t2"'] == [(100, 120, '"+"'), (161, 171, '"+"'), (241, 261, '"+"')]
+    assert d['introns']['"t2"'] == [(120, 161, '"+"'), (171, 241, '"+"')]
+    # the input annotation is left untouched
+    assert exons['"t2"'][1] == (300, 310, '"+"')
+
+def test_junction_arcs():
+    dons, accs = [200, 100, 100], [300, 150, 150]
+    records = sp.summarize_junctions(dons, accs, [5, 10, 20], [6, 8, 4], [3, 2, 5])
+    assert records == [(100, 150, 20, 8, 4, "2,5"), (200, 300, 5, 6, 3, "3")]
+
+    # anchor heights are taken from the (aggregated) coverage
+    track = ([90, 99, 100], [1, 7, 2], [9, 1, 300])
+    assert sp.summarize_junctions(dons, accs, [5, 10, 20], [6, 8, 4], [3, 2, 5], "mean", [track]) == \
+        [(100, 150, 7, 2, 4, "4"), (200, 300, 2, 2, 3, "3")]
+
+    # odd rows above and even rows below the coverage
+    arcs, labels = sp.junction_arcs(records, maxheight=30)
+    assert labels["x"] == [125, 250]
+    assert labels["y"] == [24, -9]
+    assert labels["label"] == ["2,5", "3"]
+    assert arcs["id"] == [1] * 4 + [2] * 4 + [3] * 4 + [4] * 4
+    assert arcs["x"][:4] == [100, 100, 125, 125]
+    assert arcs["y"][:4] == [20, 24, 24, 24]
+    assert arcs["y"][8:12] == [0, -9, -9, -9]
+    assert arcs["lwd"] == [sp.scale_lwd(4 / 7.)] * 2 + [sp.scale_lwd(3 / 7.)] * 2
+
+def test_save_plot():
+    s = sp.save_plot("sashimi.tif", "tiff", 300)
+    assert 'ggsave("sashimi.tif", plot = argrobs, device = "tiff"' in s
+    assert 'compression = "lzw"' in s
+    assert "compression" not in sp.save_plot("sashimi.png", "png", 300)
+
+def test_read_regions(tmpdir):
+    bed = tmpdir.join("regions.bed")
+    bed.write("track name=events\nchr10\t27040583\t27048100\tCD46 exon/13\nchr10\t100\t200\n")
+    assert sp.read_regions(str(bed)) == [("CD46_exon_13", "chr10:27040584-27048100"), ("chr10_100_200", "chr10:101-200")]
+    assert sp.region_prefix("plots/sashimi", "ev1") == "plots/sashimi_ev1"
+    assert sp.region_prefix("plots/sashimi.pdf", "ev1") == "plots/sashimi_ev1.pdf"
+
+def test_prepare_batch_region(monkeypatch):
+    def fail(*args):
+        raise StopIteration()
+    monkeypatch.setattr(sp, "prepare_plot", fail)
+    args = sp.Namespace(out_prefix="sashimi", junctions_bed="")
+    result = sp.prepare_batch_region(args, [], {}, None, "ev1", "chr10:101-200")
+    assert result[:4] == ("ev1", "chr10:101-200", "ERROR", [])
+
+def test_render_batch_region(tmpdir, monkeypatch):
+    monkeypatch.delenv("GGSASHIMI_DEBUG", raising=False)
+    data = tmpdir.join("R_data")
+    data.write("")
+    # fails whether R is installed or not
+    result = sp.render_batch_region("ev1", "chr10:101-200", "OK", ["sashimi_ev1.pdf"], 0, "q(status = 1)", str(data), 0)
+    assert result[2:4] == ("ERROR", [])
+    assert not data.check()
+
+def test_render_plot_debug(tmpdir, monkeypatch):
+    # the R script is kept next to the R data of its region
+    monkeypatch.setenv("GGSASHIMI_DEBUG", "1")
+    assert sp.render_plot("q()", str(tmpdir.join("sashimi_ev1.R_data")))[0] == "OK"
+    assert tmpdir.join("sashimi_ev1.R_script").read() == "q()"
+
+def test_merge_regions():
+    regions = ["chr2:50-60", "chr1:100-200", "chr1:150-300", "chr1:301-400", "chr1:500-600"]
+    assert sp.merge_regions(regions) == ["chr1:100-400", "chr1:500-600", "chr2:50-60"]
+
+def test_pysam_alignments():
+    pytest.importorskip("pysam")
+    if subprocess.call("samtools --version", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) != 0:
+        pytest.skip("samtools is not installed")
+    bam = "examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam"
+    for regions in [["chr10:27040584-27048100"], ["chr10:27040584-27040700", "chr10:27044550-27045000"]]:
+        expected = [(pos, flag, list(CIGAR)) for _, flag, pos, CIGAR in sp.samtools_alignments(bam, regions)]
+        assert [(pos, flag, list(CIGAR)) for _, flag, pos, CIGAR in sp.pysam_alignments(bam, regions)] == expected
+
+def test_pysam_alignments_missing_chromosome():
+    pytest.importorskip("pysam")
+    bam = "examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam"
+    assert list(sp.pysam_alignments(bam, ["chrFOO:100-2000"])) == []
+    expected = [(pos, flag, list(CIGAR)) for _, flag, pos, CIGAR in sp.pysam_alignments(bam, ["chr10:27040584-27040700"])]
+    assert expected
+    assert [(pos, flag, list(CIGAR)) for _, flag, pos, CIGAR in sp.pysam_alignments(bam, ["chr10:27040584-27040700", "chrFOO:100-2000"])] == expected
+
+def test_read_bam_regions():
+    pytest.importorskip("pysam")
+    bam = "examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam"
+    # overlapping and adjacent regions, and separate regions sharing spliced
+    # reads, which pysam reports once, in no particular order
+    regions = ["chr10:27044550-27045000", "chr10:27040584-27040700", "chr10:27044800-27048100",
+               "chr10:27048101-27049000", "chr10:27036000-27037000"]
+    for s in ["NONE", "SENSE"]:
+        expected = [sp.read_bam(bam, c, s, "pysam") for c in regions]
+        assert sp.read_bam_regions(bam, regions, s, "pysam") == expected
+
+def test_parallel_map():
+    tasks = [(i, 2) for i in range(10)]
+    for jobs in [1, 3]:
+        assert list(sp.parallel_map(pow, tasks, jobs)) == [i * i for i in range(10)]
+    # a single job runs the tasks in this process
+    assert list(sp.parallel_map(os.getpid, [()], 1)) == [os.getpid()]
+    assert os.getpid() not in sp.parallel_map(os.getpid, [()] * 4, 2)
+
+def test_r_worker(tmpdir, monkeypatch):
+    # without R on the path, each render reports an error instead of raising
+    monkeypatch.setenv("PATH", str(tmpdir))
+    worker = sp.RWorker()
+    assert worker.render("q()").startswith("ERROR")
+    assert not worker.alive()
+    assert worker.render("q()").startswith("ERROR")
+    worker.close()
+    assert not os.path.exists(worker.bootstrap)
+
+def test_process_worker():
+    # the R workers of pool processes are closed when the pool exits
+    workers = list(sp.parallel_map(sp.process_worker, [()] * 4, 2))
+    assert workers and not any(os.path.exists(w.bootstrap) for w in workers)
+
+def test_read_sample_regions_error(monkeypatch):
+    def reader(f, regions):
+        if any(c.startswith("chrBAD") for c in regions):
+            raise IOError("samtools view exited with status 1")
+        return fake_reader(READS)(f, regions)
+    monkeypatch.setitem(sp.BAM_READERS, "fake", reader)
+    good, bad = sp.read_sample_regions("sample.bam", ["chr1:1001-1400", "chrBAD:1-100"], "SENSE", "fake", 0)
+    assert good == sp.read_sample("sample.bam", "chr1:1001-1400", "SENSE", "fake", 0)
+    assert isinstance(bad, IOError)
+
+    # the region is recorded as an error in the summary of the batch
+    args = sp.Namespace(out_prefix="sashimi", junctions_bed="")
+    result = sp.prepare_batch_region(args, [], {}, None, "ev1", "chrBAD:1-100", (good, bad))
+    assert result[:4] == ("ev1", "chrBAD:1-100", "ERROR", [])
+
+def test_pipeline():
+    tasks = [(i,) for i in range(5)]
+    assert list(sp.pipeline(lambda i: (i, i * i), lambda i, j: i + j, tasks, 1)) == [0, 2, 6, 12, 20]
+
+    def fail(i):
+        if i == 3:
+            raise ValueError(i)
+        return (i,)
+    out = []
+    with pytest.raises(ValueError):
+        for x in sp.pipeline(fail, lambda i: i, tasks):
+            out.append(x)
+    assert out == [0, 1, 2]
+
+def test_samtools_alignments(tmpdir, monkeypatch):
+    # without -M the regions are read one at a time, reporting each alignment once
+    reads = [("chr1", 0, 90, [("M", 20)]), ("chr1", 0, 150, [("M", 110)]), ("chr1", 0, 260, [("M", 10)])]
+    def fake_view(f, regions):
+        assert len(regions) == 1
+        _, start, end = sp.parse_coordinates(regions[0])
+        return [r for r in reads if r[2] <= end and r[2] + r[3][0][1] - 1 > start]
+    monkeypatch.setattr(sp, "SAMTOOLS_MULTI_REGION", False)
+    monkeypatch.setattr(sp, "samtools_view", fake_view)
+    assert list(sp.samtools_alignments("sample.bam", ["chr1:100-200", "chr1:250-300"])) == reads
+
+    # a failing samtools is an error, whether it is installed or not
+    monkeypatch.undo()
+    with pytest.raises(IOError):
+        list(sp.samtools_alignments(str(tmpdir.join("missing.bam")), ["chr1:100-200"]))
+
+def test_read_cache(tmpdir):
+    bam = tmpdir.join("sample.bam")
+    bam.write("")
+    cache = sp.ReadCache(str(tmpdir), 2**20)
+    a = {"+": ([100, 110], [3, 0], [10, 5]), "-": ([100], [0], [15])}
+    junctions = {"+": OrderedDict([((109, 200), 4), ((105, 150), 1)]), "-": OrderedDict()}
+    assert cache.get(str(bam), "chr1:101-115", "SENSE") is None
+    cache.put(str(bam), "chr1:101-115", "SENSE", (a, junctions))
+    assert cache.get(str(bam), "chr1:101-115", "SENSE") == ({"+": ([100, 110], [3, 0], [10, 5]), "-": ([100], [0], [15])}, junctions)
+    assert cache.get(str(bam), "chr1:101-115", "ANTISENSE") is None
+    assert cache.get(str(bam), "chr1:101-116", "SENSE") is None
+    assert list(cache.regions(cache.sample_key(str(bam), "chr1", "SENSE"))) == [(100, 115)]
+
+    # the running size triggers the eviction of the least recently used entries
+    size = cache.total()
+    assert size > 0
+    os.utime(cache.entry(cache.sample_key(str(bam), "chr1", "SENSE"), 100, 115), (0, 0))
+    cache.size = size
+    cache.put(str(bam), "chr1:201-215", "SENSE", (a, junctions))
+    assert cache.total() == size
+    assert cache.get(str(bam), "chr1:201-215", "SENSE") is not None
+    assert cache.get(str(bam), "chr1:101-115", "SENSE") is None
+    cache.size = 0
+    cache.evict()
+    assert cache.total() == 0
+    assert cache.get(str(bam), "chr1:201-215", "SENSE") is None
+
+def test_read_cache_overlap(tmpdir, monkeypatch):
+    bam = tmpdir.join("sample.bam")
+    bam.write("")
+    fetched = []
+    monkeypatch.setitem(sp.BAM_READERS, "fake", fake_reader(READS, fetched))
+
+    cache = sp.ReadCache(str(tmpdir), 2**20)
+    for c in ["chr1:1001-1400", "chr1:1201-1900", "chr1:1101-1350", "chr1:901-1500"]:
+        a, junctions = cache.read(str(bam), c, "SENSE", "fake")
+        assert (a, junctions) == sp.read_bam(str(bam), c, "SENSE", "fake")
+    # Only the first region is read in full
+    assert fetched[0] == ["chr1:1001-1400"]
+    assert fetched[2] == ["chr1:1201-1201", "chr1:1400-1899"]
+    assert fetched[4] == ["chr1:1101-1101"]
+
+def test_store(tmpdir, monkeypatch):
+    bam = tmpdir.join("sample.bam")
+    bam.write("")
+    monkeypatch.setitem(sp.BAM_READERS, "fake", fake_reader(READS))
+    monkeypatch.setattr(sp, "bam_chromosomes", lambda f, reader: [("chr1", 5000), ("chr2", 100)])
+
+    store = str(tmpdir.join("sample.store"))
+    assert sp.build_store(str(bam), store, "SENSE", "fake", 4096)[1] == "OK"
+    assert sp.store_manifest(store)["complete"]
+    for c in ["chr1:1001-1400", "chr1:1201-1900", "chr1:1021-1060", "chr1:4001-6000"]:
+        _, start, end = sp.parse_coordinates(c)
+        a, junctions = sp.read_store(store, c, "SENSE")
+        expected_a, expected_junctions = sp.read_bam(str(bam), c, "SENSE", "fake")
+        assert junctions == expected_junctions
+        # The first position also counts the reads ending there
+        for strand in a:
+            assert a[strand][0][0] == start and sum(a[strand][2]) == end - start
+            assert sp.clip_runs(a[strand], start + 1, end) == sp.clip_runs(expected_a[strand], start + 1, end)
+    # Bins of 16 bases, exact at the junction anchors
+    a, junctions = sp.read_store(store, "chr1:1001-1400", "SENSE", (16, "max"))
+    assert a["+"][0][:5] == [1000, 1056, 1200, 1209, 1210] and a["+"][1][:5] == [1, 0, 1, 1, 1]
+    assert sp.read_store(store, "chr1:1001-1400", "SENSE")[0]["+"][0][:5] == [1000, 1050, 1200, 1210, 1290]
+    a, junctions = sp.read_store(store, "chr1:4081-4120", "SENSE", (16, "mean"))
+    assert a["+"] == ([4080, 4096, 4112], [0.375, 0.875, 0.0], [16, 16, 8])
+    assert sp.read_store(store, "chr3:1-10", "SENSE") == ({"+": ([0], [0], [10]), "-": ([0], [0], [10])}, {"+": {}, "-": {}})
+
+    # Only the missing chromosomes of an interrupted build are written again
+    os.remove(os.path.join(store, "1.cov"))
+    mtime = os.stat(os.path.join(store, "0.cov")).st_mtime
+    manifest = sp.store_manifest(store)
+    manifest["complete"] = False
+    sp.write_store_manifest(store, manifest)
+    sp.build_store(str(bam), store, "SENSE", "fake", 4096)
+    assert os.path.isfile(os.path.join(store, "1.cov"))
+    assert os.stat(os.path.join(store, "0.cov")).st_mtime == mtime
+
+def test_tiled_region_coverage():
+    # with reads starting before the regions and deletions
+    reads = sorted(READS + [(990, 0, [("M", 50)]), (1300, 16, [("S", 5), ("M", 25), ("D", 3), ("M", 10), ("N", 50), ("M", 25)])])
+    for c in ["chr1:1001-1400", "chr1:1021-1301", "chr1:1300-1310"]:
+        region = sp.RegionCoverage(c, "SENSE")
+        for pos, flag, CIGAR in reads:
+            region.add(flag, pos, CIGAR)
+        for tile in [1, 3, 7]:
+            tiled = sp.region_coverage(c, "SENSE", tile)
+            assert isinstance(tiled, sp.TiledRegionCoverage)
+            for pos, flag, CIGAR in reads:
+                tiled.add(flag, pos, CIGAR)
+            assert tiled.result() == region.result()
+    assert not isinstance(sp.region_coverage("chr1:1001-1400", "SENSE", 400), sp.TiledRegionCoverage)